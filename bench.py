@@ -0,0 +1,409 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2009 Andris Reinman (http://www.turbinecms.com, http://www.andrisreinman.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+# For details, see the TurbineCMS web site: http://www.turbinecms.com/
+
+# Benchmark harness
+#
+# Seeds an in-memory site (localdb on ':memory:' and localcache) and drives
+# the handlers through the WSGI application under three scenarios:
+#
+#   cold         both cache tiers are flushed before every request
+#   warm         every url is requested once before measuring
+#   invalidated  the content generation is bumped before every request,
+#                like after saving a page
+#
+# The cold start of a new instance (importing main and serving the first
+# request) is measured separately in fresh interpreters.
+#
+# Results are written as json so runs can be compared between commits:
+#
+#   python bench.py --sdk /path/to/google_appengine [--pages 200] [--output results.json]
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import optparse
+import subprocess
+
+try:
+  from cStringIO import StringIO
+except ImportError:
+  from io import BytesIO as StringIO
+
+try:
+  from urllib import urlencode
+except ImportError:
+  from urllib.parse import urlencode
+
+SCENARIOS = ('cold', 'warm', 'invalidated')
+
+# setup_environment()
+# @param sdk String
+# function puts the App Engine SDK libraries on the path and selects the
+# local storage backends, it has to run before main is imported. The host
+# matches the environ of request()
+
+def setup_environment(sdk):
+  os.environ['TURBINE_STORAGE'] = 'sqlite'
+  os.environ['TURBINE_SQLITE_PATH'] = ':memory:'
+  os.environ.setdefault('SERVER_SOFTWARE', 'Development/bench')
+  os.environ.setdefault('SERVER_NAME', 'localhost')
+  os.environ.setdefault('SERVER_PORT', '8080')
+  os.environ.setdefault('HTTP_HOST', 'localhost:8080')
+  os.environ.setdefault('APPLICATION_ID', 'bench')
+  os.environ.setdefault('AUTH_DOMAIN', 'example.com')
+  os.environ.setdefault('USER_EMAIL', 'admin@example.com')
+  os.environ.setdefault('USER_IS_ADMIN', '1')
+  sdk = sdk or os.environ.get('APPENGINE_SDK')
+  if sdk:
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+  sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+  os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+# load_main()
+# @return Module
+# function imports the application and registers the API stubs the admin
+# pages and the image uploads need
+
+def load_main():
+  import main as turbine
+  turbine.register_local_stubs()
+  return turbine
+
+# request()
+# @param app WSGIApplication
+# @param path String
+# @param method String
+# @param data Dictionary
+# @param headers Dictionary
+# @return Tuple
+# function runs a single request through the WSGI application and returns
+# the status code and the length of the body. Form data is posted
+
+def request(app, path, method='GET', data=None, headers=None):
+  body = data and urlencode(data).encode('utf-8') or b''
+  path, _, query = path.partition('?')
+  environ = {
+    'REQUEST_METHOD': method,
+    'PATH_INFO': path,
+    'QUERY_STRING': query,
+    'SERVER_NAME': 'localhost',
+    'SERVER_PORT': '8080',
+    'SERVER_PROTOCOL': 'HTTP/1.1',
+    'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+    'CONTENT_LENGTH': str(len(body)),
+    'HTTP_HOST': 'localhost:8080',
+    'wsgi.input': StringIO(body),
+    'wsgi.errors': sys.stderr,
+    'wsgi.url_scheme': 'http',
+    'wsgi.version': (1, 0),
+    'wsgi.multithread': False,
+    'wsgi.multiprocess': False,
+    'wsgi.run_once': False
+  }
+  for name, value in (headers or {}).items():
+    environ['HTTP_' + name.upper().replace('-', '_')] = value
+
+  status = []
+  def start_response(code, response_headers, exc_info=None):
+    status.append(int(code.split()[0]))
+  length = 0
+  for chunk in app(environ, start_response):
+    length += len(chunk)
+  return status[0], length
+
+# send()
+# @param app WSGIApplication
+# @param entry String or Tuple
+# @return Tuple
+# function requests a benchmark entry, a path for a GET request or a path
+# with form data for a POST request
+
+def send(app, entry):
+  if isinstance(entry, tuple):
+    return request(app, entry[0], 'POST', entry[1])
+  return request(app, entry)
+
+# seed()
+# @param turbine Module
+# @param options Values
+# @return Dictionary
+# function creates the pages, subpages and media of the benchmark site and
+# returns the request entries per handler (see send())
+
+def seed(turbine, options):
+  app = turbine.application
+
+  def post(path, data):
+    status, length = request(app, path, 'POST', data)
+    if status >= 400:
+      raise RuntimeError('seeding %s failed with status %d' % (path, status))
+  rand = random.Random(options.seed)
+  words = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+           'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+
+  def text(count):
+    return ' '.join(rand.choice(words) for i in range(count))
+
+  top = []
+  for i in range(options.pages):
+    post('/admin/edit', {
+      'key': '', 'title': 'Page %d %s' % (i, text(2)), 'url': 'page-%d' % i,
+      'content': '<p>%s</p>' % text(300)
+    })
+    top.append(turbine.get_page('page-%d' % i))
+
+  subpages = []
+  for i in range(options.pages * options.subpages):
+    owner = top[i % len(top)]
+    post('/admin/edit', {
+      'key': '', 'title': 'Subpage %d %s' % (i, text(2)), 'url': 'subpage-%d' % i,
+      'owner': str(owner.key()), 'content': '<p>%s</p>' % text(200)
+    })
+    subpages.append('subpage-%d' % i)
+
+  images = []
+  files = []
+  for i in range(options.media):
+    media = turbine.Media(name=u'media-%d.jpg' % i, description=u'')
+    if i % 2:
+      # stored as chunks like uploads too large for the images API
+      media.type = 'FILE'
+      media.width = media.height = 0
+      media.put()
+      turbine.store_media_chunks(media, StringIO(os.urandom(options.media_size)))
+      files.append(str(media.key()))
+    else:
+      # image bytes are not decoded by the full and thumb sizes, random
+      # data keeps the benchmark independent of the images API
+      media.type = 'IMAGE'
+      media.file = turbine.db.Blob(os.urandom(options.media_size))
+      media.thumbnail = turbine.db.Blob(os.urandom(2000))
+      media.size = options.media_size
+      media.width, media.height = 800, 600
+      media.put()
+      images.append(str(media.key()))
+
+  return {
+    'PageHandler': ['/'] + ['/page/page-%d' % i for i in range(len(top))] +
+                   ['/page/%s' % url for url in subpages],
+    'FeedHandler': ['/feed'],
+    'ImageHandler': ['/image/%s/%s/media.jpg' % (size, key) for key in images for size in ('full', 'thumb')],
+    'MediaHandler': ['/download/%s/media.bin' % key for key in files],
+    'AdminEditHandler': ['/admin/edit/page-%d' % i for i in range(len(top))],
+    # saving an unchanged page runs the whole save path: indexes, menu,
+    # feed, generation bump and snapshots
+    'AdminEditHandler.post': [('/admin/edit', {
+      'key': str(page.key()), 'title': page.title, 'url': page.url, 'content': page.content
+    }) for page in top]
+  }
+
+# flush_caches()
+# @param turbine Module
+# function empties both cache tiers, the rendered templates stay compiled
+
+def flush_caches(turbine):
+  turbine.memcache.flush_all()
+  turbine.local_cache.clear()
+  turbine.local_generation['value'] = None
+
+# percentile()
+# @param values List
+# @param fraction Float
+# @return Float
+# function returns the nearest-rank percentile of sorted values
+
+def percentile(values, fraction):
+  if not values:
+    return 0.0
+  index = max(0, int(math.ceil(fraction * len(values))) - 1)
+  return values[min(index, len(values) - 1)]
+
+# measure()
+# @param turbine Module
+# @param paths List
+# @param scenario String
+# @param requests Integer
+# @return Dictionary
+# function requests the entries round robin and returns the statistics of
+# the run
+
+def measure(turbine, paths, scenario, requests):
+  app = turbine.application
+  if scenario == 'warm':
+    for path in paths:
+      send(app, path)
+
+  stats = turbine.memcache.get_stats()
+  calls = sum(turbine.db.call_counts.values())
+  latencies = []
+  errors = 0
+  started = time.time()
+  for i in range(requests):
+    if scenario == 'cold':
+      flush_caches(turbine)
+    elif scenario == 'invalidated':
+      turbine.bump_generation()
+    path = paths[i % len(paths)]
+    begin = time.time()
+    status, length = send(app, path)
+    latencies.append(time.time() - begin)
+    if status >= 400:
+      errors += 1
+  elapsed = time.time() - started
+
+  after = turbine.memcache.get_stats()
+  hits = after['hits'] - stats['hits']
+  misses = after['misses'] - stats['misses']
+  latencies.sort()
+  return {
+    'requests': requests,
+    'errors': errors,
+    'req_per_sec': round(requests / elapsed, 2) if elapsed else None,
+    'p50_ms': round(percentile(latencies, 0.5) * 1000, 3),
+    'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+    'cache_hit_ratio': round(float(hits) / (hits + misses), 4) if hits + misses else None,
+    'datastore_calls_per_request': round(float(sum(turbine.db.call_counts.values()) - calls) / requests, 3)
+  }
+
+# startup_child()
+# @param options Values
+# function runs in a fresh interpreter, imports main, serves the front page
+# once and prints the timings as json for startup()
+
+def startup_child(options):
+  setup_environment(options.sdk)
+  started = time.time()
+  turbine = load_main()
+  imported = time.time()
+  status, length = request(turbine.application, '/')
+  served = time.time()
+  print(json.dumps({
+    'status': status,
+    'import_ms': round((imported - started) * 1000, 3),
+    'first_request_ms': round((served - imported) * 1000, 3)
+  }))
+
+# startup()
+# @param options Values
+# @return Dictionary
+# function measures the cold start of an instance in separate processes and
+# returns the median timings
+
+def startup(options):
+  command = [sys.executable, os.path.abspath(__file__), '--startup-child']
+  if options.sdk:
+    command.extend(['--sdk', options.sdk])
+  runs = []
+  for i in range(options.startups):
+    process = subprocess.Popen(command, stdout=subprocess.PIPE)
+    output = process.communicate()[0]
+    if process.returncode:
+      raise RuntimeError('startup run failed with exit code %d' % process.returncode)
+    runs.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+
+  def median(name):
+    return percentile(sorted([run[name] for run in runs]), 0.5)
+  return {
+    'runs': len(runs),
+    'errors': len([run for run in runs if run['status'] >= 400]),
+    'import_ms': median('import_ms'),
+    'first_request_ms': median('first_request_ms')
+  }
+
+def main():
+  parser = optparse.OptionParser(usage='%prog [options]')
+  parser.add_option('--sdk', help='path of the App Engine SDK (or set APPENGINE_SDK)')
+  parser.add_option('--pages', type='int', default=50, help='top level pages to seed')
+  parser.add_option('--subpages', type='int', default=4, help='subpages per top level page')
+  parser.add_option('--media', type='int', default=20, help='media items to seed, half images and half files')
+  parser.add_option('--media-size', type='int', default=200000, help='bytes per media item')
+  parser.add_option('--requests', type='int', default=200, help='requests per handler and scenario')
+  parser.add_option('--handlers', default='', help='comma separated handler names, all by default')
+  parser.add_option('--seed', type='int', default=1, help='random seed of the generated content')
+  parser.add_option('--output', help='file to write the json results to, stdout by default')
+  parser.add_option('--startups', type='int', default=5, help='fresh processes to measure the cold start with')
+  parser.add_option('--startup-child', action='store_true', help=optparse.SUPPRESS_HELP)
+  options, args = parser.parse_args()
+
+  if options.startup_child:
+    startup_child(options)
+    return
+  started = options.startups and startup(options) or None
+
+  setup_environment(options.sdk)
+  turbine = load_main()
+
+  seeded = time.time()
+  paths = seed(turbine, options)
+  seeded = time.time() - seeded
+
+  handlers = options.handlers and options.handlers.split(',') or sorted(paths)
+  results = {}
+  for handler in handlers:
+    if not paths.get(handler):
+      continue
+    results[handler] = {}
+    for scenario in SCENARIOS:
+      results[handler][scenario] = measure(turbine, paths[handler], scenario, options.requests)
+
+  report = {
+    'python': sys.version.split()[0],
+    'options': {
+      'pages': options.pages,
+      'subpages': options.subpages,
+      'media': options.media,
+      'media_size': options.media_size,
+      'requests': options.requests,
+      'seed': options.seed
+    },
+    'seed_seconds': round(seeded, 3),
+    'startup': started,
+    'results': results
+  }
+  output = json.dumps(report, indent=2, sort_keys=True)
+  if options.output:
+    out = open(options.output, 'w')
+    out.write(output + '\n')
+    out.close()
+  else:
+    print(output)
+
+  # timings of failing requests are meaningless, the run must not pass
+  failed = ['%s %s' % (handler, scenario) for handler in sorted(results)
+            for scenario in SCENARIOS if results[handler][scenario]['errors']]
+  if started and started['errors']:
+    failed.append('startup')
+  if failed:
+    sys.stderr.write('Requests failed in: %s\n' % ', '.join(failed))
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2009 Andris Reinman (http://www.turbinecms.com, http://www.andrisreinman.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+# For details, see the TurbineCMS web site: http://www.turbinecms.com/
+
+# In-process cache backend
+#
+# Implements the google.appengine.api.memcache functions TurbineCMS uses,
+# for running outside of App Engine together with localdb. Values are
+# pickled like memcache does, so callers never share mutable objects with
+# the cache. Memory is bounded by TURBINE_CACHE_SIZE bytes (default 64 MB),
+# least recently used values are evicted first.
+
+import os
+import time
+import threading
+
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+
+try:
+  long
+except NameError:
+  long = int
+
+DELETE_NETWORK_FAILURE = 0
+DELETE_ITEM_MISSING = 1
+DELETE_SUCCESSFUL = 2
+
+MAX_VALUE_SIZE = 1000000 # same limit as memcache
+
+_lock = threading.RLock()
+_items = {} # key -> (pickled value, expires, last access)
+_stats = {'hits': 0, 'misses': 0, 'byte_hits': 0, 'items': 0, 'bytes': 0, 'oldest_item_age': 0}
+_clock = [0]
+
+def _limit():
+  return int(os.environ.get('TURBINE_CACHE_SIZE', 64*1024*1024))
+
+def _expires(expire_time):
+  if not expire_time:
+    return 0
+  if expire_time > 30*24*60*60:
+    return expire_time # absolute unix time
+  return time.time() + expire_time
+
+def _live(key):
+  # returns the stored item, dropping it if it has expired
+  item = _items.get(key)
+  if item is not None and item[1] and item[1] < time.time():
+    _remove(key)
+    item = None
+  return item
+
+def _remove(key):
+  item = _items.pop(key, None)
+  if item is not None:
+    _stats['items'] -= 1
+    _stats['bytes'] -= len(item[0])
+
+def _store(key, value, expire_time):
+  data = pickle.dumps(value, 2)
+  if len(data) > MAX_VALUE_SIZE:
+    return False
+  _remove(key)
+  _clock[0] += 1
+  _items[key] = (data, _expires(expire_time), _clock[0])
+  _stats['items'] += 1
+  _stats['bytes'] += len(data)
+  if _stats['bytes'] > _limit():
+    _evict()
+  return True
+
+def _evict():
+  # drops the least recently used quarter of the items
+  ordered = sorted(_items.items(), key=lambda item: item[1][2])
+  for key, item in ordered[:max(1, len(ordered) // 4)]:
+    _remove(key)
+
+def _key(key, prefix=''):
+  if isinstance(key, tuple):
+    key = key[1]
+  return prefix + str(key)
+
+# get()
+# @param key String
+# @return Object
+# function returns the cached value, None on a miss
+
+def get(key, namespace=None):
+  _lock.acquire()
+  try:
+    item = _live(_key(key))
+    if item is None:
+      _stats['misses'] += 1
+      return None
+    _stats['hits'] += 1
+    _stats['byte_hits'] += len(item[0])
+    _clock[0] += 1
+    _items[_key(key)] = (item[0], item[1], _clock[0])
+    return pickle.loads(item[0])
+  finally:
+    _lock.release()
+
+def get_multi(keys, key_prefix='', namespace=None):
+  results = {}
+  for key in keys:
+    value = get(_key(key, key_prefix))
+    if value is not None:
+      results[key] = value
+  return results
+
+def set(key, value, time=0, min_compress_len=0, namespace=None):
+  _lock.acquire()
+  try:
+    return _store(_key(key), value, time)
+  finally:
+    _lock.release()
+
+def set_multi(mapping, time=0, key_prefix='', min_compress_len=0, namespace=None):
+  failed = []
+  for key, value in mapping.items():
+    if not set(_key(key, key_prefix), value, time):
+      failed.append(key)
+  return failed
+
+def add(key, value, time=0, min_compress_len=0, namespace=None):
+  _lock.acquire()
+  try:
+    if _live(_key(key)) is not None:
+      return False
+    return _store(_key(key), value, time)
+  finally:
+    _lock.release()
+
+def replace(key, value, time=0, min_compress_len=0, namespace=None):
+  _lock.acquire()
+  try:
+    if _live(_key(key)) is None:
+      return False
+    return _store(_key(key), value, time)
+  finally:
+    _lock.release()
+
+def delete(key, seconds=0, namespace=None):
+  _lock.acquire()
+  try:
+    if _live(_key(key)) is None:
+      return DELETE_ITEM_MISSING
+    _remove(_key(key))
+    return DELETE_SUCCESSFUL
+  finally:
+    _lock.release()
+
+def delete_multi(keys, seconds=0, key_prefix='', namespace=None):
+  for key in keys:
+    delete(_key(key, key_prefix))
+  return True
+
+def incr(key, delta=1, namespace=None, initial_value=None):
+  _lock.acquire()
+  try:
+    item = _live(_key(key))
+    if item is None:
+      if initial_value is None:
+        return None
+      value = initial_value
+      expires = 0
+    else:
+      value = pickle.loads(item[0])
+      if not isinstance(value, (int, long)):
+        return None
+      expires = item[1]
+    value = max(0, value + delta)
+    _store(_key(key), value, 0)
+    _items[_key(key)] = (_items[_key(key)][0], expires, _clock[0])
+    return value
+  finally:
+    _lock.release()
+
+def decr(key, delta=1, namespace=None, initial_value=None):
+  return incr(key, -delta, namespace, initial_value)
+
+def flush_all():
+  _lock.acquire()
+  try:
+    for key in list(_items.keys()):
+      _remove(key)
+    return True
+  finally:
+    _lock.release()
+
+def get_stats():
+  _lock.acquire()
+  try:
+    return dict(_stats)
+  finally:
+    _lock.release()
@@ -0,0 +1,954 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2009 Andris Reinman (http://www.turbinecms.com, http://www.andrisreinman.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files (the
+# "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so, subject to
+# the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE
+# LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION
+# WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+#
+# For details, see the TurbineCMS web site: http://www.turbinecms.com/
+
+# SQLite storage backend
+#
+# Implements the part of the google.appengine.ext.db API that TurbineCMS
+# uses (models, properties, keys, queries with filters, sort orders and
+# cursors, batch get/put/delete and transactions) on top of SQLite, so the
+# CMS can run outside of App Engine. main.py uses it instead of the
+# datastore when TURBINE_STORAGE=sqlite is set.
+#
+# Every model gets its own table with a column per property and an index
+# on every indexed property. List properties are stored as json and also
+# in a side table (<kind>__<property>) that list membership filters use.
+# Composite indexes are read from index.yaml when PyYAML is available.
+# The database is opened in WAL mode, every thread gets its own pooled
+# connection. The database file is taken from TURBINE_SQLITE_PATH
+# (default turbine.db), ':memory:' shares a single connection between threads.
+
+import os
+import re
+import base64
+import threading
+import sqlite3
+from datetime import datetime
+
+try:
+  import json
+except ImportError:
+  from django.utils import simplejson as json
+
+try:
+  unicode
+except NameError:
+  unicode = str
+  basestring = str
+  long = int
+
+
+########################### ERRORS ###########################
+
+class Error(Exception):
+  pass
+
+class BadValueError(Error):
+  pass
+
+class BadKeyError(Error):
+  pass
+
+class BadArgumentError(Error):
+  pass
+
+class NotSavedError(Error):
+  pass
+
+class KindError(Error):
+  pass
+
+class ReferencePropertyResolveError(Error):
+  pass
+
+class TransactionFailedError(Error):
+  pass
+
+
+########################### VALUE TYPES ###########################
+
+class Blob(bytes):
+  pass
+
+class Text(unicode):
+  pass
+
+# Key
+# Identifies an entity by its path, a list of (kind, id or name) pairs
+# starting from the root entity. The string form is url safe
+
+class Key(object):
+  def __init__(self, encoded=None):
+    self._path = ()
+    if encoded is None:
+      return
+    try:
+      encoded = str(encoded)
+      raw = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4))
+      path = json.loads(raw.decode('utf-8'))
+      self._path = tuple([(kind, id_or_name) for kind, id_or_name in path])
+    except Exception:
+      raise BadKeyError('Invalid string key %s' % encoded)
+    if not self._path:
+      raise BadKeyError('Invalid string key %s' % encoded)
+
+  @classmethod
+  def from_path(cls, *args, **kwds):
+    if len(args) % 2:
+      raise BadArgumentError('Key path must have an even number of elements')
+    parent = kwds.get('parent')
+    path = parent and list(parent._path) or []
+    for i in range(0, len(args), 2):
+      kind, id_or_name = args[i], args[i+1]
+      if isinstance(kind, type):
+        kind = kind.kind()
+      if isinstance(id_or_name, basestring):
+        if not id_or_name or id_or_name[0].isdigit():
+          raise BadArgumentError('Key names must not be empty or start with a digit')
+      elif not isinstance(id_or_name, (int, long)):
+        raise BadArgumentError('Key ids must be integers')
+      path.append((kind, id_or_name))
+    key = cls()
+    key._path = tuple(path)
+    return key
+
+  def kind(self):
+    return self._path[-1][0]
+
+  def id(self):
+    id_or_name = self._path[-1][1]
+    return not isinstance(id_or_name, basestring) and id_or_name or None
+
+  def name(self):
+    id_or_name = self._path[-1][1]
+    return isinstance(id_or_name, basestring) and id_or_name or None
+
+  def id_or_name(self):
+    return self._path[-1][1]
+
+  def parent(self):
+    if len(self._path) < 2:
+      return None
+    key = Key()
+    key._path = self._path[:-1]
+    return key
+
+  def __str__(self):
+    raw = json.dumps([list(step) for step in self._path], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+  def __repr__(self):
+    return 'Key.from_path(%s)' % ', '.join([repr(part) for step in self._path for part in step])
+
+  def __eq__(self, other):
+    return isinstance(other, Key) and self._path == other._path
+
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+  def __lt__(self, other):
+    return self._path < other._path
+
+  def __hash__(self):
+    return hash(self._path)
+
+  def __getstate__(self):
+    return {'_path': self._path}
+
+  def __setstate__(self, state):
+    self._path = state['_path']
+
+
+########################### PROPERTIES ###########################
+
+class Property(object):
+  column_type = 'TEXT'
+  indexed = True
+
+  def __init__(self, verbose_name=None, name=None, default=None, required=False, indexed=True, **kwds):
+    self.verbose_name = verbose_name
+    self.name = name
+    self.default = default
+    self.required = required
+    self.indexed = self.indexed and indexed
+
+  def default_value(self):
+    return self.default
+
+  def validate(self, value):
+    return value
+
+  def __get__(self, instance, owner):
+    if instance is None:
+      return self
+    return instance._values.get(self.name)
+
+  def __set__(self, instance, value):
+    instance._values[self.name] = self.validate(value)
+
+  def get_value_for_datastore(self, instance):
+    return instance._values.get(self.name)
+
+  # to_db()/from_db() convert between python values and SQLite column
+  # values, None is handled by the caller
+  def to_db(self, value):
+    return value
+
+  def from_db(self, value):
+    return value
+
+class StringProperty(Property):
+  def validate(self, value):
+    if value is not None and not isinstance(value, basestring):
+      raise BadValueError('Property %s must be a string' % self.name)
+    return value
+
+class TextProperty(StringProperty):
+  indexed = False
+
+  def from_db(self, value):
+    return Text(value)
+
+class BooleanProperty(Property):
+  column_type = 'INTEGER'
+
+  def to_db(self, value):
+    return int(bool(value))
+
+  def from_db(self, value):
+    return bool(value)
+
+class IntegerProperty(Property):
+  column_type = 'INTEGER'
+
+  def validate(self, value):
+    if value is not None and (isinstance(value, bool) or not isinstance(value, (int, long))):
+      raise BadValueError('Property %s must be an integer' % self.name)
+    return value
+
+class BlobProperty(Property):
+  column_type = 'BLOB'
+  indexed = False
+
+  def to_db(self, value):
+    return sqlite3.Binary(value)
+
+  def from_db(self, value):
+    return Blob(bytes(value))
+
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+class DateTimeProperty(Property):
+  def __init__(self, verbose_name=None, auto_now=False, auto_now_add=False, **kwds):
+    Property.__init__(self, verbose_name, **kwds)
+    self.auto_now = auto_now
+    self.auto_now_add = auto_now_add
+
+  def to_db(self, value):
+    return value.strftime(DATETIME_FORMAT)
+
+  def from_db(self, value):
+    return datetime.strptime(value, DATETIME_FORMAT)
+
+# Key values are stored as their string form
+def _key_to_db(value):
+  if isinstance(value, Model):
+    value = value.key()
+  elif isinstance(value, basestring):
+    value = Key(value)
+  return value is not None and str(value) or None
+
+class ReferenceProperty(Property):
+  def __init__(self, reference_class=None, verbose_name=None, collection_name=None, **kwds):
+    Property.__init__(self, verbose_name, **kwds)
+    self.reference_class = reference_class
+    self.collection_name = collection_name
+
+  def __get__(self, instance, owner):
+    if instance is None:
+      return self
+    key = instance._values.get(self.name)
+    if key is None:
+      return None
+    resolved = instance._resolved.get(self.name)
+    if resolved is None or resolved.key() != key:
+      resolved = get(key)
+      if resolved is None:
+        raise ReferencePropertyResolveError('ReferenceProperty failed to be resolved')
+      instance._resolved[self.name] = resolved
+    return resolved
+
+  def __set__(self, instance, value):
+    instance._resolved.pop(self.name, None)
+    if isinstance(value, Model):
+      instance._resolved[self.name] = value
+      value = value.key()
+    elif isinstance(value, basestring):
+      value = Key(value)
+    instance._values[self.name] = value
+
+  def to_db(self, value):
+    return _key_to_db(value)
+
+  def from_db(self, value):
+    return Key(value)
+
+class SelfReferenceProperty(ReferenceProperty):
+  def __init__(self, verbose_name=None, collection_name=None, **kwds):
+    ReferenceProperty.__init__(self, None, verbose_name, collection_name, **kwds)
+
+# _ReverseReferenceProperty
+# The <kind>_set query attribute a ReferenceProperty adds to the referenced model
+
+class _ReverseReferenceProperty(object):
+  def __init__(self, model, property_name):
+    self.model = model
+    self.property_name = property_name
+
+  def __get__(self, instance, owner):
+    if instance is None:
+      return self
+    return self.model.all().filter('%s =' % self.property_name, instance.key())
+
+class ListProperty(Property):
+  def __init__(self, item_type, verbose_name=None, default=None, **kwds):
+    Property.__init__(self, verbose_name, default=default, **kwds)
+    self.item_type = item_type
+
+  def default_value(self):
+    return list(self.default or [])
+
+  def validate(self, value):
+    return value is not None and list(value) or []
+
+  def item_to_db(self, item):
+    if self.item_type is Key:
+      return _key_to_db(item)
+    if isinstance(item, datetime):
+      return item.strftime(DATETIME_FORMAT)
+    return item
+
+  def item_from_db(self, item):
+    if self.item_type is Key:
+      return Key(item)
+    return item
+
+  def to_db(self, value):
+    return json.dumps([self.item_to_db(item) for item in value or []])
+
+  def from_db(self, value):
+    return [self.item_from_db(item) for item in json.loads(value or '[]')]
+
+class StringListProperty(ListProperty):
+  def __init__(self, verbose_name=None, default=None, **kwds):
+    ListProperty.__init__(self, basestring, verbose_name, default=default, **kwds)
+
+
+########################### MODELS ###########################
+
+_kinds = {}
+
+# PropertiedClass
+# Metaclass of Model, collects the properties and registers the kind
+
+class PropertiedClass(type):
+  def __init__(cls, name, bases, dct):
+    type.__init__(cls, name, bases, dct)
+    cls._properties = {}
+    for base in reversed(cls.__mro__[1:]):
+      cls._properties.update(getattr(base, '_properties', {}))
+    for attr, value in dct.items():
+      if isinstance(value, Property):
+        value.name = attr
+        cls._properties[attr] = value
+    if dct.get('__module__') == __name__:
+      return # ModelBase and Model itself
+    _kinds[name] = cls
+    for prop in cls._properties.values():
+      if isinstance(prop, ReferenceProperty) and prop.name in dct:
+        if prop.reference_class is None:
+          prop.reference_class = cls
+        collection = prop.collection_name or '%s_set' % name.lower()
+        setattr(prop.reference_class, collection, _ReverseReferenceProperty(cls, prop.name))
+
+ModelBase = PropertiedClass('ModelBase', (object,), {})
+
+class Model(ModelBase):
+  def __init__(self, parent=None, key_name=None, key=None, **kwds):
+    self._values = {}
+    self._resolved = {}
+    self._key = key
+    if key is None and key_name is not None:
+      self._key = Key.from_path(self.kind(), key_name, parent=parent and _parent_key(parent))
+    self._parent = parent is not None and _parent_key(parent) or None
+    for name, prop in self._properties.items():
+      if name in kwds:
+        setattr(self, name, kwds[name])
+      else:
+        self._values[name] = prop.default_value()
+
+  def __getstate__(self):
+    return {'_values': self._values, '_key': self._key, '_parent': self._parent, '_resolved': {}}
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+
+  @classmethod
+  def kind(cls):
+    return cls.__name__
+
+  @classmethod
+  def properties(cls):
+    return dict(cls._properties)
+
+  def key(self):
+    if self._key is None:
+      raise NotSavedError('Entity has not been saved yet')
+    return self._key
+
+  def is_saved(self):
+    return self._key is not None
+
+  def parent_key(self):
+    return self._key and self._key.parent() or self._parent
+
+  def put(self):
+    put(self)
+    return self._key
+
+  save = put
+
+  def delete(self):
+    delete(self)
+
+  @classmethod
+  def get(cls, keys):
+    multiple = isinstance(keys, (list, tuple))
+    keys = [isinstance(key, Key) and key or Key(key) for key in _listed(keys)]
+    for key in keys:
+      if key.kind() != cls.kind():
+        raise KindError('Kind %s is not %s' % (key.kind(), cls.kind()))
+    entities = get(keys)
+    return _unlisted(entities, multiple)
+
+  @classmethod
+  def get_by_key_name(cls, key_names, parent=None):
+    multiple = isinstance(key_names, (list, tuple))
+    parent = parent and _parent_key(parent)
+    keys = [Key.from_path(cls.kind(), name, parent=parent) for name in _listed(key_names)]
+    entities = get(keys)
+    return _unlisted(entities, multiple)
+
+  @classmethod
+  def get_by_id(cls, ids, parent=None):
+    multiple = isinstance(ids, (list, tuple))
+    parent = parent and _parent_key(parent)
+    keys = [Key.from_path(cls.kind(), int(i), parent=parent) for i in _listed(ids)]
+    entities = get(keys)
+    return _unlisted(entities, multiple)
+
+  @classmethod
+  def all(cls, keys_only=False):
+    return Query(cls, keys_only=keys_only)
+
+def _parent_key(parent):
+  return isinstance(parent, Model) and parent.key() or parent
+
+
+########################### CONNECTIONS ###########################
+
+# ConnectionPool
+# Hands out one connection per thread; a thread keeps reusing its connection.
+# In-memory databases can't be shared between connections, so they use a
+# single connection guarded by a lock
+
+class _NoLock(object):
+  def acquire(self):
+    pass
+
+  def release(self):
+    pass
+
+class ConnectionPool(object):
+  def __init__(self, path):
+    self.path = path
+    self.shared = path == ':memory:'
+    # statements only need to be serialized when threads share the connection.
+    # The schema lock is the same lock then, so there is a single lock order
+    self.lock = self.shared and threading.RLock() or _NoLock()
+    self.schema_lock = self.shared and self.lock or threading.RLock()
+    self.local = threading.local()
+    self.tables = {}
+    self.shared_connection = None
+    self.composite_indexes = _load_composite_indexes()
+
+  def connection(self):
+    if self.shared:
+      if self.shared_connection is None:
+        self.shared_connection = self.connect()
+      return self.shared_connection
+    conn = getattr(self.local, 'connection', None)
+    if conn is None:
+      conn = self.local.connection = self.connect()
+    return conn
+
+  def connect(self):
+    conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+    if not self.shared:
+      conn.execute('PRAGMA journal_mode=WAL')
+      conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS "__ids__" (kind TEXT PRIMARY KEY, next INTEGER)')
+    return conn
+
+  def execute(self, sql, params=()):
+    self.lock.acquire()
+    try:
+      return self.connection().execute(sql, params).fetchall()
+    finally:
+      self.lock.release()
+
+  def table(self, model):
+    # creates the table of a model on first use, adding columns for new properties
+    kind = model.kind()
+    if kind in self.tables:
+      return self.tables[kind]
+    self.schema_lock.acquire()
+    self.lock.acquire()
+    try:
+      conn = self.connection()
+      conn.execute('CREATE TABLE IF NOT EXISTS "%s" (key TEXT PRIMARY KEY, parent TEXT)' % kind)
+      conn.execute('CREATE INDEX IF NOT EXISTS "%s__parent" ON "%s" (parent)' % (kind, kind))
+      existing = [row[1] for row in conn.execute('PRAGMA table_info("%s")' % kind)]
+      for name, prop in model._properties.items():
+        if name not in existing:
+          conn.execute('ALTER TABLE "%s" ADD COLUMN "%s" %s' % (kind, name, prop.column_type))
+        if isinstance(prop, ListProperty):
+          side = '%s__%s' % (kind, name)
+          conn.execute('CREATE TABLE IF NOT EXISTS "%s" (key TEXT, value)' % side)
+          conn.execute('CREATE INDEX IF NOT EXISTS "%s__value" ON "%s" (value, key)' % (side, side))
+          conn.execute('CREATE INDEX IF NOT EXISTS "%s__key" ON "%s" (key)' % (side, side))
+        elif prop.indexed:
+          conn.execute('CREATE INDEX IF NOT EXISTS "%s__%s" ON "%s" ("%s")' % (kind, name, kind, name))
+      for columns in self.composite_indexes.get(kind, []):
+        if len([c for c in columns if c.split()[0] in model._properties]) == len(columns):
+          conn.execute('CREATE INDEX IF NOT EXISTS "%s__%s" ON "%s" (%s)' % (
+              kind, '_'.join([c.split()[0] for c in columns]), kind,
+              ', '.join(['"%s" %s' % tuple((c + ' ').split(' ', 1)) for c in columns])))
+      self.tables[kind] = model
+      return model
+    finally:
+      self.lock.release()
+      self.schema_lock.release()
+
+  def allocate_id(self, kind):
+    rows = self.execute('SELECT next FROM "__ids__" WHERE kind = ?', (kind,))
+    next_id = rows and rows[0][0] or 1
+    self.execute('INSERT OR REPLACE INTO "__ids__" (kind, next) VALUES (?, ?)', (kind, next_id + 1))
+    return next_id
+
+# _load_composite_indexes()
+# reads the composite indexes from index.yaml as {kind: [[column, ...], ...]}
+
+def _load_composite_indexes():
+  indexes = {}
+  path = os.path.join(os.path.dirname(__file__), 'index.yaml')
+  try:
+    import yaml
+    definitions = yaml.safe_load(open(path)) or {}
+  except Exception:
+    return indexes
+  for index in definitions.get('indexes') or []:
+    columns = []
+    for prop in index.get('properties', []):
+      columns.append(prop.get('direction') == 'desc' and '%s DESC' % prop['name'] or prop['name'])
+    indexes.setdefault(index['kind'], []).append(columns)
+  return indexes
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def pool():
+  global _pool
+  if _pool is None:
+    _pool_lock.acquire()
+    try:
+      if _pool is None:
+        _pool = ConnectionPool(os.environ.get('TURBINE_SQLITE_PATH', 'turbine.db'))
+    finally:
+      _pool_lock.release()
+  return _pool
+
+# reset()
+# closes the database so the next call opens TURBINE_SQLITE_PATH again (for tests and benchmarks)
+
+def reset():
+  global _pool
+  _pool = None
+
+# _listed() / _unlisted()
+# the datastore functions take and return single values or lists alike
+
+def _listed(value):
+  if isinstance(value, (list, tuple)):
+    return list(value)
+  return [value]
+
+def _unlisted(values, multiple):
+  if multiple:
+    return values
+  return values[0]
+
+# Datastore calls made through this module, by operation
+call_counts = {}
+
+def _count(operation):
+  call_counts[operation] = call_counts.get(operation, 0) + 1
+
+
+########################### OPERATIONS ###########################
+
+def _model_for(kind):
+  try:
+    return _kinds[kind]
+  except KeyError:
+    raise KindError('No implementation for kind %s' % kind)
+
+def _from_row(model, columns, row):
+  entity = model.__new__(model)
+  entity._values = {}
+  entity._resolved = {}
+  values = dict(zip(columns, row))
+  entity._key = Key(values['key'])
+  entity._parent = entity._key.parent()
+  for name, prop in model._properties.items():
+    value = values.get(name)
+    if value is None and not isinstance(prop, ListProperty):
+      entity._values[name] = None
+    else:
+      entity._values[name] = prop.from_db(value)
+  return entity
+
+def _as_key(value):
+  if isinstance(value, Model):
+    return value.key()
+  if isinstance(value, Key):
+    return value
+  return Key(value)
+
+# get()
+# @param keys Key or Array
+# @return Model or Array
+# function fetches entities by key, None for the keys that don't exist
+
+def get(keys):
+  _count('get')
+  multiple = isinstance(keys, (list, tuple))
+  keys = [_as_key(key) for key in _listed(keys)]
+  found = {}
+  by_kind = {}
+  for key in keys:
+    by_kind.setdefault(key.kind(), []).append(str(key))
+  p = pool()
+  for kind, encoded in by_kind.items():
+    model = p.table(_model_for(kind))
+    for i in range(0, len(encoded), 500):
+      batch = encoded[i:i+500]
+      p.lock.acquire()
+      try:
+        cursor = p.connection().execute('SELECT * FROM "%s" WHERE key IN (%s)' % (kind, ','.join(['?'] * len(batch))), batch)
+        columns = [d[0] for d in cursor.description]
+        for row in cursor.fetchall():
+          entity = _from_row(model, columns, row)
+          found[entity._key] = entity
+      finally:
+        p.lock.release()
+  entities = [found.get(key) for key in keys]
+  return _unlisted(entities, multiple)
+
+# put()
+# @param models Model or Array
+# @return Key or Array
+# function saves entities, assigning ids to new entities without a key name
+
+def put(models):
+  _count('put')
+  multiple = isinstance(models, (list, tuple))
+  models = _listed(models)
+  p = pool()
+  now = datetime.utcnow()
+
+  def write():
+    for model in models:
+      cls = p.table(type(model))
+      if model._key is None:
+        model._key = Key.from_path(cls.kind(), p.allocate_id(cls.kind()), parent=model._parent)
+      columns = ['key', 'parent']
+      values = [str(model._key), model._key.parent() and str(model._key.parent()) or None]
+      lists = []
+      for name, prop in cls._properties.items():
+        if isinstance(prop, DateTimeProperty):
+          if prop.auto_now or (prop.auto_now_add and model._values.get(name) is None):
+            model._values[name] = now
+        value = model._values.get(name)
+        if isinstance(prop, ListProperty):
+          value = value or []
+          lists.append((name, prop, value))
+        if value is not None:
+          value = prop.to_db(value)
+        columns.append('"%s"' % name)
+        values.append(value)
+      p.execute('INSERT OR REPLACE INTO "%s" (%s) VALUES (%s)' % (cls.kind(), ', '.join(columns), ', '.join(['?'] * len(values))), values)
+      for name, prop, items in lists:
+        side = '%s__%s' % (cls.kind(), name)
+        p.execute('DELETE FROM "%s" WHERE key = ?' % side, (str(model._key),))
+        for item in items:
+          p.execute('INSERT INTO "%s" (key, value) VALUES (?, ?)' % side, (str(model._key), prop.item_to_db(item)))
+
+  _in_transaction(write)
+  keys = [model._key for model in models]
+  return _unlisted(keys, multiple)
+
+# delete()
+# @param models Model, Key or Array
+# function removes entities
+
+def delete(models):
+  _count('delete')
+  multiple = isinstance(models, (list, tuple))
+  keys = [_as_key(model) for model in _listed(models)]
+  p = pool()
+
+  def remove():
+    for key in keys:
+      if key.kind() not in _kinds:
+        continue
+      cls = p.table(_model_for(key.kind()))
+      p.execute('DELETE FROM "%s" WHERE key = ?' % cls.kind(), (str(key),))
+      for name, prop in cls._properties.items():
+        if isinstance(prop, ListProperty):
+          p.execute('DELETE FROM "%s__%s" WHERE key = ?' % (cls.kind(), name), (str(key),))
+
+  _in_transaction(remove)
+
+_transaction = threading.local()
+
+def _in_transaction(function, *args, **kwds):
+  # runs function inside a transaction, joining the current one if there is one
+  if getattr(_transaction, 'depth', 0):
+    return function(*args, **kwds)
+  p = pool()
+  p.lock.acquire()
+  _transaction.depth = 1
+  try:
+    conn = p.connection()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+      result = function(*args, **kwds)
+    except:
+      conn.execute('ROLLBACK')
+      raise
+    conn.execute('COMMIT')
+    return result
+  finally:
+    _transaction.depth = 0
+    p.lock.release()
+
+# run_in_transaction()
+# @param function Function
+# @return Object
+# function calls function(*args, **kwds) inside a transaction and returns its result
+
+def run_in_transaction(function, *args, **kwds):
+  _count('transaction')
+  return _in_transaction(function, *args, **kwds)
+
+
+########################### QUERIES ###########################
+
+FILTER = re.compile(r'^\s*(\w+)\s*(=|==|<|<=|>|>=|!=)?\s*$')
+
+# Query
+# Model query with equality and inequality filters, sort orders, offsets and cursors.
+# A cursor holds the sort values and the key of the last fetched row, the
+# next fetch continues after that row (not after a row count), so paging
+# doesn't slow down with depth and rows added or removed in between don't
+# shift the pages
+
+class Query(object):
+  def __init__(self, model, keys_only=False):
+    self.model = model
+    self.keys_only = keys_only
+    self.filters = []
+    self.orders = []
+    self.after = None # sort values and key of the row the query continues after
+    self.last = None
+    self.fetched = False
+
+  def filter(self, property_operator, value):
+    match = FILTER.match(property_operator)
+    if not match:
+      raise BadArgumentError('Filter not supported: %s' % property_operator)
+    name, operator = match.group(1), match.group(2) or '='
+    if operator == '==':
+      operator = '='
+    if name == '__key__':
+      self.filters.append(('key', operator, str(_as_key(value)), None))
+      return self
+    prop = self.model._properties.get(name)
+    if prop is None:
+      raise BadArgumentError('Unknown property %s' % name)
+    if isinstance(prop, ListProperty):
+      if operator != '=':
+        raise BadArgumentError('Only equality filters are supported on list properties')
+      self.filters.append((name, operator, prop.item_to_db(value), prop))
+    elif isinstance(prop, ReferenceProperty):
+      self.filters.append((name, operator, _key_to_db(value), prop))
+    else:
+      if value is not None:
+        value = prop.to_db(value)
+      self.filters.append((name, operator, value, prop))
+    return self
+
+  def order(self, property):
+    descending = property.startswith('-')
+    name = property.lstrip('-')
+    if name != '__key__' and name not in self.model._properties:
+      raise BadArgumentError('Unknown property %s' % name)
+    self.orders.append((name == '__key__' and 'key' or name, descending))
+    return self
+
+  def ancestor(self, ancestor):
+    self.filters.append(('parent', '=', str(_as_key(ancestor)), None))
+    return self
+
+  def with_cursor(self, cursor):
+    try:
+      after = json.loads(base64.urlsafe_b64decode(str(cursor)).decode('utf-8'))
+    except Exception:
+      raise BadValueError('Invalid cursor %s' % cursor)
+    if after is not None and not isinstance(after, list):
+      raise BadValueError('Invalid cursor %s' % cursor)
+    self.after = after
+    return self
+
+  def cursor(self):
+    if not self.fetched:
+      raise AssertionError('No cursor available, fetch() the query first')
+    return base64.urlsafe_b64encode(json.dumps(self.last).encode('utf-8')).decode('ascii')
+
+  def sort_columns(self):
+    # the sort orders with the key as the final tie breaker
+    return self.orders + [('key', False)]
+
+  def after_condition(self, params):
+    # rows sorting after self.after, NULL sorts first like in SQLite
+    columns = self.sort_columns()
+    if len(self.after) != len(columns):
+      raise BadValueError('Cursor does not match the sort orders of the query')
+    conditions = []
+    for i, (name, descending) in enumerate(columns):
+      value = self.after[i]
+      if value is None and descending:
+        continue # nothing sorts after NULL in descending order
+      parts = []
+      values = []
+      for (previous, _), previous_value in zip(columns[:i], self.after[:i]):
+        parts.append('"%s" IS ?' % previous)
+        values.append(previous_value)
+      if value is None:
+        parts.append('"%s" IS NOT NULL' % name)
+      elif descending:
+        parts.append('("%s" < ? OR "%s" IS NULL)' % (name, name))
+        values.append(value)
+      else:
+        parts.append('"%s" > ?' % name)
+        values.append(value)
+      conditions.append('(%s)' % ' AND '.join(parts))
+      params.extend(values)
+    return conditions and '(%s)' % ' OR '.join(conditions) or '0'
+
+  def sql(self, limit, offset):
+    kind = self.model.kind()
+    where = []
+    params = []
+    for name, operator, value, prop in self.filters:
+      if isinstance(prop, ListProperty):
+        where.append('key IN (SELECT key FROM "%s__%s" WHERE value = ?)' % (kind, name))
+        params.append(value)
+      elif value is None and operator in ('=', '!='):
+        where.append('"%s" IS %s NULL' % (name, operator == '!=' and 'NOT' or ''))
+      else:
+        where.append('"%s" %s ?' % (name, operator))
+        params.append(value)
+    if self.after is not None:
+      where.append(self.after_condition(params))
+    selected = '*'
+    if self.keys_only:
+      selected = ', '.join(['key'] + ['"%s"' % name for name, descending in self.orders if name != 'key'])
+    sql = 'SELECT %s FROM "%s"' % (selected, kind)
+    if where:
+      sql += ' WHERE ' + ' AND '.join(where)
+    orders = ['"%s"%s' % (name, descending and ' DESC' or '') for name, descending in self.orders]
+    sql += ' ORDER BY ' + ', '.join(orders + ['key'])
+    sql += ' LIMIT %d OFFSET %d' % (limit, offset)
+    return sql, params
+
+  def fetch(self, limit, offset=0):
+    _count('query')
+    p = pool()
+    p.table(self.model)
+    sql, params = self.sql(limit, offset)
+    p.lock.acquire()
+    try:
+      cursor = p.connection().execute(sql, params)
+      columns = [d[0] for d in cursor.description]
+      rows = cursor.fetchall()
+    finally:
+      p.lock.release()
+    self.fetched = True
+    self.last = self.after
+    if rows:
+      values = dict(zip(columns, rows[-1]))
+      self.last = [values[name] for name, descending in self.sort_columns()]
+    if self.keys_only:
+      return [Key(row[0]) for row in rows]
+    return [_from_row(self.model, columns, row) for row in rows]
+
+  def get(self):
+    results = self.fetch(1)
+    return results and results[0] or None
+
+  def count(self, limit=1000):
+    return len(self.fetch(limit))
+
+  def __iter__(self):
+    offset = 0
+    while True:
+      batch = self.fetch(100, offset)
+      for result in batch:
+        yield result
+      if len(batch) < 100:
+        return
+      offset += 100
@@ -27,21 +27,32 @@
 ########################### IMPORT DECLARATIONS ###########################
 
 # HTTP related 
-import wsgiref.handlers
 from google.appengine.ext import webapp
 
 # Storage
-from google.appengine.ext import db
-from google.appengine.api import memcache
+# TURBINE_STORAGE=sqlite swaps the datastore and memcache for the local
+# SQLite (localdb) and in-process cache (localcache) backends, which
+# implement the same API, to run outside of App Engine
+import os
+if os.environ.get('TURBINE_STORAGE') == 'sqlite':
+  import localdb as db
+  import localcache as memcache
+else:
+  from google.appengine.ext import db
+  from google.appengine.api import memcache
 
 # Views
 from google.appengine.ext.webapp import template
-from django.template import Context, Template # for custom templates
-from django.template.loader import render_to_string
+from django.template import Context, Template # for custom templates, loaded with webapp.template anyway
+from django.utils.text import truncate_html_words
 
 # System
-import os
+import sys
 import re
+import time
+import threading
+import bisect
+import heapq
 from datetime import datetime, date, timedelta
 from google.appengine.api import users
 
@@ -49,7 +60,28 @@ from google.appengine.api import users
 from django.utils import simplejson as json
 import urllib
 import logging
-from google.appengine.api import images
+import hashlib
+import base64
+import math
+try:
+  from htmlentitydefs import name2codepoint
+except ImportError:
+  from html.entities import name2codepoint
+
+# Modules only some requests need are imported on first use, see images_api()
+_images = None
+
+# images_api()
+# @return Module
+# function returns the App Engine images API, importing it on the first call.
+# Only uploads and image derivatives need it, so other requests skip the import
+
+def images_api():
+  global _images
+  if _images is None:
+    from google.appengine.api import images
+    _images = images
+  return _images
 
 
 ########################### DATABASE DEFINITIONS ###########################
@@ -71,6 +103,55 @@ class Page(db.Model):
   owner = db.SelfReferenceProperty()
   created = db.DateTimeProperty(auto_now_add=True)
   edited = db.DateTimeProperty(auto_now=True)
+  # derived from content when the page is saved, see preprocess_page()
+  html = db.TextProperty() # normalized and minified content
+  excerpt = db.TextProperty() # plain text, FEED_EXCERPT_WORDS words
+  word_count = db.IntegerProperty()
+  image_keys = db.StringListProperty() # media keys or digests of the /image/ urls in the content
+
+  # body()
+  # @return String
+  # function returns the HTML to show, pages saved by older versions have
+  # no preprocessed html yet
+  def body(self):
+    return self.html or self.content
+
+# PageUrl table maps page urls to pages. The key name is 'url:' + url, so a
+# page is found by its url with key lookups only, no query needed
+
+class PageUrl(db.Model):
+  page = db.ReferenceProperty(Page)
+
+# PageNode table is a lightweight copy of the page tree. The key name is the
+# key of the page, ancestors holds the keys of the owner chain (root first)
+# so breadcrumbs and subpage listings don't need the full page entities
+
+class PageNode(db.Model):
+  owner = db.ReferenceProperty(Page, collection_name='child_nodes')
+  ancestors = db.ListProperty(db.Key)
+  title = db.StringProperty()
+  url = db.StringProperty()
+  draft = db.BooleanProperty()
+  created = db.DateTimeProperty()
+  summary = db.TextProperty()
+
+# SearchEntry table is the full-text search index, one row per published
+# page (key name = page key). terms holds the distinct words of the page, the
+# datastore index of the list property serves as the inverted index.
+# Term frequencies are kept as json for ranking
+
+class SearchEntry(db.Model):
+  terms = db.StringListProperty()
+  frequencies = db.TextProperty()
+  length = db.IntegerProperty()
+  title = db.StringProperty()
+  url = db.StringProperty()
+  summary = db.TextProperty()
+
+# Media table holds the metadata of uploads, so listings never load any
+# file data. The payload is kept in MediaBlob (images) or MediaChunk (files)
+# rows, file and thumbnail are only set on uploads from older versions.
+# Uploads with the same digest share one stored payload, see blob_parent()
 
 class Media(db.Model):
   name = db.StringProperty()
@@ -81,6 +162,42 @@ class Media(db.Model):
   width = db.IntegerProperty()
   height = db.IntegerProperty()
   uploaded = db.DateTimeProperty(auto_now_add = True)
+  size = db.IntegerProperty()
+  chunks = db.IntegerProperty(default=0) # number of MediaChunk rows, 0 for payloads kept in file
+  chunk_size = db.IntegerProperty()
+  status = db.StringProperty(default='OK') # PROCESSING while the upload waits for process_upload()
+  digest = db.StringProperty() # sha1 hex digest of the uploaded bytes, None for uploads from older versions
+
+# MediaChunk table holds the payload of uploaded files in ordered pieces, as
+# children of the blob parent (see blob_parent()) with key names c0, c1, ...
+# so a file can be larger than a single entity and read piece by piece
+
+class MediaChunk(db.Model):
+  data = db.BlobProperty()
+
+# MediaBlob table holds the stored sizes of images as children of the blob
+# parent, the key name is the size ('full' or 'thumb')
+
+class MediaBlob(db.Model):
+  data = db.BlobProperty()
+
+# MediaDerivative table holds resized versions of images, as children of the
+# blob parent. The key name is 's' + the size ('sw320', 's320x240' etc.),
+# key names must not start with a digit, see derivative_key().
+# Least recently accessed derivatives are removed when there are too many
+
+class MediaDerivative(db.Model):
+  data = db.BlobProperty()
+  accessed = db.DateTimeProperty(auto_now_add=True)
+
+# Snapshot table holds the pre-rendered public views when the site is in
+# snapshot mode (the snapshots site setting). The key name is 'page:' + url
+# for pages, 'front' for the front page and 'feed' for the RSS feed
+
+class Snapshot(db.Model):
+  body = db.TextProperty()
+  etag = db.StringProperty()
+  modified = db.DateTimeProperty()
 
 ########################### HELPER FUNCTIONS ###########################
 
@@ -89,9 +206,9 @@ class Media(db.Model):
 # function retrieves site preferences as an array (title, description etc.)
 
 def get_site_prefs():
-  site_prefs= memcache.get("site-prefs")
+  site_prefs= cache_get("site-prefs")
   if site_prefs is not None:
-    return site_prefs
+    return dict(site_prefs)
   else:
 
     defaults = {
@@ -99,7 +216,11 @@ def get_site_prefs():
         'description': u'TurbineCMS is a lightweight CMS designed to run on Google App Engine',
         'front': False,
         'templateDefault': True,
-        'templateText': False
+        'templateText': False,
+        'feedItems': 10,
+        'feedExcerpts': False,
+        'slowRequestMs': 0,
+        'snapshots': False
     }
     
     file = open('views/base.html')
@@ -107,7 +228,7 @@ def get_site_prefs():
     file.close()
 
     site_prefs = False
-    query = db.GqlQuery("SELECT * FROM Setting WHERE name = :1", "site_prefs")
+    query = Setting.all().filter('name =', 'site_prefs')
     for sp in query:
       try:
         site_prefs = sp.value and json.loads(sp.value) or defaults
@@ -120,15 +241,26 @@ def get_site_prefs():
       s.value = json.dumps(site_prefs)
       s.put()
 
-    memcache.set("site-prefs", site_prefs)
-    return site_prefs
+    # preferences saved by an older version may lack the newer settings
+    for name in defaults:
+      if name not in site_prefs:
+        site_prefs[name] = defaults[name]
+
+    cache_set("site-prefs", site_prefs)
+    return dict(site_prefs)
 
 # set_site_prefs()
 # @param site_prefs Array
-# function saves site preferences to database and memcache
+# @return Boolean
+# function saves site preferences to database and memcache. Cached
+# renderings and snapshots are only rebuilt if a preference that shows on
+# the site changed, returns True if they were
+
+UNRENDERED_PREFS = frozenset(['slowRequestMs'])
 
 def set_site_prefs(site_prefs):
-  query = db.GqlQuery("SELECT * FROM Setting WHERE name = :1", "site_prefs")
+  previous = get_site_prefs()
+  query = Setting.all().filter('name =', 'site_prefs')
   s = False
   for sp in query:
     try:
@@ -140,8 +272,795 @@ def set_site_prefs(site_prefs):
   s.name = 'site_prefs'
   s.value = json.dumps(site_prefs)
   s.put()
-  memcache.set("site-prefs", site_prefs)
-  memcache.delete('feed')
+  cache_set("site-prefs", site_prefs)
+
+  changed = [name for name in set(previous.keys() + site_prefs.keys())
+             if name not in UNRENDERED_PREFS and previous.get(name) != site_prefs.get(name)]
+  if not changed:
+    return False
+  cache_invalidate('feed')
+  bump_generation()
+  template_cache.clear()
+  if site_prefs.get('snapshots'):
+    refresh_snapshots(everything=True)
+  else:
+    clear_snapshots()
+  warm_template_cache(site_prefs)
+  return True
+
+# text_digest()
+# @param text String
+# @return String
+# function returns the md5 hex digest of a (unicode or byte) string
+
+def text_digest(text):
+  if isinstance(text, unicode):
+    text = text.encode('utf-8')
+  return hashlib.md5(text).hexdigest()
+
+# LocalCache
+# Per-process LRU cache in front of memcache. Entries are tagged with the
+# content generation they were stored under and are only returned while
+# that generation is current, so bumping the generation keeps all
+# processes coherent. Entries also expire after LOCAL_CACHE_TTL seconds
+
+LOCAL_CACHE_SIZE = 500
+LOCAL_CACHE_TTL = 60
+# key prefixes of values that are invalidated without a generation bump (the
+# media info and the media list), a local copy in another process would
+# outlive the invalidation so they are only kept in memcache
+LOCAL_CACHE_EXCLUDED = ('media_', 'media-list')
+GENERATION_CHECK_INTERVAL = 2 # seconds a process trusts its copy of the generation
+
+class LocalCache(object):
+  def __init__(self, size=LOCAL_CACHE_SIZE, ttl=LOCAL_CACHE_TTL):
+    self.size = size
+    self.ttl = ttl
+    self.items = {}
+    self.tick = 0
+    self.lock = threading.Lock()
+
+  def get(self, key, generation):
+    self.lock.acquire()
+    try:
+      item = self.items.get(key)
+      if item is None:
+        return None
+      value, stored_generation, expires, tick = item
+      if stored_generation != generation or expires < time.time():
+        del self.items[key]
+        return None
+      self.tick += 1
+      self.items[key] = (value, stored_generation, expires, self.tick)
+      return value
+    finally:
+      self.lock.release()
+
+  def set(self, key, value, generation):
+    if key.startswith(LOCAL_CACHE_EXCLUDED):
+      return
+    self.lock.acquire()
+    try:
+      self.tick += 1
+      self.items[key] = (value, generation, time.time() + self.ttl, self.tick)
+      if len(self.items) > self.size:
+        # drop the least recently used quarter
+        ordered = sorted(self.items.items(), key=lambda item: item[1][3])
+        for old_key, item in ordered[:self.size // 4]:
+          del self.items[old_key]
+    finally:
+      self.lock.release()
+
+  def delete(self, key):
+    self.lock.acquire()
+    try:
+      self.items.pop(key, None)
+    finally:
+      self.lock.release()
+
+  def clear(self):
+    self.lock.acquire()
+    try:
+      self.items.clear()
+    finally:
+      self.lock.release()
+
+local_cache = LocalCache()
+local_generation = {'value': None, 'checked': 0}
+
+# RequestCache
+# Request-scoped view of the cache. Handlers declare the keys they need with
+# prefetch() and get them in a single get_multi call. Writes and deletes are
+# visible to the rest of the request right away but reach memcache in one
+# set_multi/delete_multi when the request ends, or before the content
+# generation is bumped
+
+class RequestCache(object):
+  def __init__(self):
+    self.values = {}
+    self.pending_sets = {}
+    self.pending_deletes = set()
+
+  def prefetch(self, keys):
+    generation = get_generation()
+    missing = []
+    for key in keys:
+      if key in self.values:
+        continue
+      value = local_cache.get(key, generation)
+      if value is None:
+        missing.append(key)
+      else:
+        self.values[key] = value
+    if missing:
+      found = memcache.get_multi(missing)
+      for key in missing:
+        value = found.get(key)
+        self.values[key] = value
+        if value is not None:
+          local_cache.set(key, value, generation)
+
+  def set(self, key, value):
+    self.values[key] = value
+    self.pending_sets[key] = value
+    self.pending_deletes.discard(key)
+
+  def delete(self, key):
+    self.values[key] = None
+    self.pending_deletes.add(key)
+    self.pending_sets.pop(key, None)
+
+  def flush(self):
+    if self.pending_deletes:
+      memcache.delete_multi(list(self.pending_deletes))
+    if self.pending_sets:
+      memcache.set_multi(self.pending_sets)
+    self.pending_deletes = set()
+    self.pending_sets = {}
+
+request_state = threading.local()
+
+# begin_request() / end_request()
+# @param host String
+# functions open the request cache and flush it when the request is done
+
+def begin_request(host=None):
+  request_state.cache = RequestCache()
+  request_state.host = host
+
+def end_request():
+  cache = getattr(request_state, 'cache', None)
+  request_state.cache = None
+  request_state.host = None
+  if cache:
+    cache.flush()
+
+# request_host()
+# @return String
+# function returns the host name of the current request (or of the request
+# that queued the running task) for the absolute links of the feed. Plain
+# WSGI servers do not put HTTP_HOST into os.environ
+
+def request_host():
+  return getattr(request_state, 'host', None) or os.environ.get('HTTP_HOST') or 'localhost'
+
+# environ_host()
+# @param environ Dictionary
+# @return String
+# function returns the host of a WSGI request, like webob's Request.host
+
+def environ_host(environ):
+  if environ.get('HTTP_HOST'):
+    return environ['HTTP_HOST']
+  host = environ.get('SERVER_NAME', 'localhost')
+  port = environ.get('SERVER_PORT')
+  if port and port != {'https': '443'}.get(environ.get('wsgi.url_scheme'), '80'):
+    host += ':' + port
+  return host
+
+# prefetch()
+# @param keys Array
+# function loads the given cache keys for the current request in one batch
+
+def prefetch(keys):
+  cache = getattr(request_state, 'cache', None)
+  if cache:
+    cache.prefetch(keys)
+
+# cache_get()
+# @param key String
+# @return Object
+# function looks up a value in the request cache, then in the local cache
+# and in memcache after that
+
+def cache_get(key):
+  cache = getattr(request_state, 'cache', None)
+  if cache and key in cache.values:
+    return cache.values[key]
+  generation = get_generation()
+  value = local_cache.get(key, generation)
+  if value is None:
+    value = memcache.get(key)
+    if value is not None:
+      local_cache.set(key, value, generation)
+  if cache:
+    cache.values[key] = value
+  return value
+
+# shared_get()
+# @param key String
+# @return Object
+# function reads a value straight from memcache (honouring the writes of the
+# current request), for read-modify-write updates that must not work on a
+# stale local copy
+
+def shared_get(key):
+  cache = getattr(request_state, 'cache', None)
+  if cache:
+    if key in cache.pending_sets:
+      return cache.pending_sets[key]
+    if key in cache.pending_deletes:
+      return None
+  return memcache.get(key)
+
+# cache_set()
+# @param key String
+# @param value Object
+# function stores a value in memcache and the local cache
+
+def cache_set(key, value):
+  local_cache.set(key, value, get_generation())
+  cache = getattr(request_state, 'cache', None)
+  if cache:
+    cache.set(key, value)
+  else:
+    memcache.set(key, value)
+
+# cache_delete()
+# @param key String
+# function removes a value from memcache and the local cache
+
+def cache_delete(key):
+  local_cache.delete(key)
+  cache = getattr(request_state, 'cache', None)
+  if cache:
+    cache.delete(key)
+  else:
+    memcache.delete(key)
+
+# Stampede protection
+# When a cached value is missing, only the request holding the lease of the
+# key rebuilds it. The others get the stale copy of the value meanwhile, or
+# wait up to LEASE_WAIT_STEPS * LEASE_WAIT seconds for the rebuilt one
+# (building it themselves after that). Leases expire after LEASE_TIME
+# seconds in case the rebuilding request dies
+
+LEASE_TIME = 10
+LEASE_WAIT = 0.05
+LEASE_WAIT_STEPS = 20
+STALE_TIME = 60 # seconds an invalidated value is served while it is rebuilt
+
+# cache_set_now()
+# @param key String
+# @param value Object
+# function stores a value in memcache right away instead of at the end of
+# the request, so concurrent requests see it at once
+
+def cache_set_now(key, value):
+  local_cache.set(key, value, get_generation())
+  cache = getattr(request_state, 'cache', None)
+  if cache:
+    cache.values[key] = value
+    cache.pending_sets.pop(key, None)
+    cache.pending_deletes.discard(key)
+  memcache.set(key, value)
+
+# cache_invalidate()
+# @param key String
+# function marks a cached value stale: it is removed, but a copy is kept
+# under 'stale-' + key for STALE_TIME seconds for cache_get_or_build()
+
+def cache_invalidate(key):
+  value = shared_get(key)
+  if value is not None:
+    memcache.set('stale-%s' % key, value, time=STALE_TIME)
+  cache_delete(key)
+
+# cache_get_or_build()
+# @param key String
+# @param build Function
+# @param stale_key String
+# @return Object
+# function returns the cached value of key. On a miss the value is built
+# with build() by one request at a time, the stale copy (stale_key,
+# 'stale-' + key by default) is returned to the others meanwhile. Values
+# built as None are not cached
+
+def cache_get_or_build(key, build, stale_key=None):
+  value = cache_get(key)
+  if value is not None:
+    return value
+
+  lease = 'lease-%s' % key
+  if memcache.add(lease, 1, time=LEASE_TIME):
+    try:
+      value = build()
+      if value is not None:
+        cache_set_now(key, value)
+    finally:
+      memcache.delete(lease)
+    return value
+
+  stale = memcache.get(stale_key or 'stale-%s' % key)
+  if stale is not None:
+    return stale
+  for i in range(LEASE_WAIT_STEPS):
+    time.sleep(LEASE_WAIT)
+    value = memcache.get(key)
+    if value is not None:
+      return value
+
+  value = build()
+  if value is not None:
+    cache_set(key, value)
+  return value
+
+# get_generation()
+# @return Integer
+# function returns the site-wide content generation number. Rendered pages
+# are cached under the current generation, so bumping it invalidates all of
+# them. The number is read from memcache at most every GENERATION_CHECK_INTERVAL seconds
+
+def get_generation():
+  now = time.time()
+  if local_generation['value'] is not None and now - local_generation['checked'] < GENERATION_CHECK_INTERVAL:
+    return local_generation['value']
+
+  generation = memcache.get('site-generation')
+  if generation is None:
+    # seed with the current time so a generation evicted from memcache is
+    # never reused for different content
+    generation = int(time.time())
+    if not memcache.add('site-generation', generation):
+      generation = memcache.get('site-generation') or generation
+  if generation != local_generation['value']:
+    local_cache.clear()
+  local_generation['value'] = generation
+  local_generation['checked'] = now
+  return generation
+
+# bump_generation()
+# function moves the site to a new content generation, invalidating all
+# cached renderings. The cache writes of the request are flushed first, so
+# no request rebuilds from stale values under the new generation
+
+def bump_generation():
+  cache = getattr(request_state, 'cache', None)
+  if cache:
+    cache.flush()
+  generation = memcache.incr('site-generation')
+  if generation is None:
+    generation = int(time.time())
+    memcache.set('site-generation', generation)
+  local_cache.clear()
+  local_generation['value'] = generation
+  local_generation['checked'] = time.time()
+
+# Request statistics
+# Datastore calls, memcache operations, template renders and image transforms
+# are counted and timed for every request. The totals are kept per route in
+# buckets of STATS_BUCKET seconds, with a histogram of the request times,
+# and moved to memcache every STATS_FLUSH_INTERVAL seconds so /admin/stats
+# can show the last STATS_WINDOW buckets of all instances
+
+STATS_BUCKET = 60
+STATS_WINDOW = 60
+STATS_FLUSH_INTERVAL = 10
+STATS_HISTOGRAM = (10, 25, 50, 100, 250, 500, 1000, 2500) # upper bounds in ms, the last bucket is open ended
+STATS_CATEGORIES = ('datastore', 'memcache', 'template', 'images')
+STATS_SERVICES = {'datastore_v3': 'datastore', 'memcache': 'memcache', 'images': 'images'}
+SLOW_REQUEST_LOG_SIZE = 50
+
+pending_stats = {'buckets': {}, 'flushed': time.time()}
+pending_stats_lock = threading.Lock()
+
+# begin_stats()
+# function starts collecting the call statistics of the current request
+
+def begin_stats():
+  request_state.stats = {}
+  request_state.stats_active = {}
+  request_state.rpc_started = []
+  request_state.started = time.time()
+
+# record_call()
+# @param category String
+# @param seconds Float
+# function adds a call to the statistics of the current request
+
+def record_call(category, seconds):
+  stats = getattr(request_state, 'stats', None)
+  if stats is None:
+    return
+  entry = stats.setdefault(category, [0, 0.0])
+  entry[0] += 1
+  entry[1] += seconds
+
+# timed()
+# @param category String
+# @param function Function
+# @return Function
+# function wraps a function so its calls are recorded under category. Calls
+# made from inside a recorded call of the same category (get_multi calling
+# get etc.) are not counted twice
+
+def timed(category, function):
+  def wrapper(*args, **kwds):
+    active = getattr(request_state, 'stats_active', None)
+    if active is None or active.get(category):
+      return function(*args, **kwds)
+    active[category] = True
+    started = time.time()
+    try:
+      return function(*args, **kwds)
+    finally:
+      active[category] = False
+      record_call(category, time.time() - started)
+  wrapper.__name__ = function.__name__
+  wrapper.__doc__ = function.__doc__
+  wrapper.timed = True
+  return wrapper
+
+# stats_pre_call() / stats_post_call()
+# API proxy hooks that time the datastore, memcache and images RPCs on App Engine
+
+def stats_pre_call(service, call, request, response):
+  started = getattr(request_state, 'rpc_started', None)
+  if started is not None:
+    started.append(time.time())
+
+def stats_post_call(service, call, request, response):
+  started = getattr(request_state, 'rpc_started', None)
+  if started:
+    record_call(STATS_SERVICES.get(service, service), time.time() - started.pop())
+
+# install_instrumentation()
+# function hooks the statistics into the API proxy, the template renderer
+# and, when running on them, the local storage backends
+
+def install_instrumentation():
+  if getattr(template.render, 'timed', False):
+    return
+  template.render = timed('template', template.render)
+  try:
+    from google.appengine.api import apiproxy_stub_map
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('turbine-stats', stats_pre_call)
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('turbine-stats', stats_post_call)
+  except (ImportError, AttributeError):
+    logging.debug('API proxy hooks not available')
+  if os.environ.get('TURBINE_STORAGE') == 'sqlite':
+    for name in ('get', 'put', 'delete', 'run_in_transaction'):
+      setattr(db, name, timed('datastore', getattr(db, name)))
+    db.Query.fetch = timed('datastore', db.Query.__dict__['fetch'])
+    for name in ('get', 'get_multi', 'set', 'set_multi', 'add', 'replace',
+                 'delete', 'delete_multi', 'incr', 'decr'):
+      setattr(memcache, name, timed('memcache', getattr(memcache, name)))
+
+# new_route_stats()
+# @return Dictionary
+# function returns empty totals for a route
+
+def new_route_stats():
+  return {
+      'requests': 0,
+      'seconds': 0.0,
+      'histogram': [0] * (len(STATS_HISTOGRAM) + 1),
+      'calls': {}
+  }
+
+# merge_route_stats()
+# @param target Dictionary
+# @param source Dictionary
+# function adds the totals of source to target
+
+def merge_route_stats(target, source):
+  target['requests'] += source['requests']
+  target['seconds'] += source['seconds']
+  for i, count in enumerate(source['histogram']):
+    target['histogram'][i] += count
+  for category, (count, seconds) in source['calls'].items():
+    entry = target['calls'].setdefault(category, [0, 0.0])
+    entry[0] += count
+    entry[1] += seconds
+
+# end_stats()
+# @param route String
+# @param path String
+# function adds the statistics of the finished request to the totals of its
+# route and writes requests slower than the slowRequestMs site setting to
+# the slow request log
+
+def end_stats(route, path):
+  calls = getattr(request_state, 'stats', None)
+  if calls is None:
+    return
+  elapsed = time.time() - request_state.started
+  request_state.stats = None
+  request_state.stats_active = None
+  request_state.rpc_started = None
+
+  request = new_route_stats()
+  request['requests'] = 1
+  request['seconds'] = elapsed
+  request['histogram'][bisect.bisect_left(STATS_HISTOGRAM, elapsed * 1000)] += 1
+  request['calls'] = calls
+
+  bucket = int(time.time() // STATS_BUCKET)
+  buckets = None
+  pending_stats_lock.acquire()
+  try:
+    routes = pending_stats['buckets'].setdefault(bucket, {})
+    merge_route_stats(routes.setdefault(route, new_route_stats()), request)
+    if time.time() - pending_stats['flushed'] >= STATS_FLUSH_INTERVAL:
+      buckets = pending_stats['buckets']
+      pending_stats['buckets'] = {}
+      pending_stats['flushed'] = time.time()
+  finally:
+    pending_stats_lock.release()
+  if buckets:
+    flush_stats(buckets)
+
+  threshold = get_site_prefs().get('slowRequestMs')
+  if threshold and elapsed * 1000 >= threshold:
+    log_slow_request(route, path, elapsed, calls)
+
+# flush_stats()
+# @param buckets Dictionary
+# function adds the totals collected by this instance to the shared totals in memcache
+
+def flush_stats(buckets):
+  keys = ['stats-%d' % bucket for bucket in buckets]
+  shared = memcache.get_multi(keys)
+  for bucket, routes in buckets.items():
+    key = 'stats-%d' % bucket
+    totals = shared.get(key) or {}
+    for route, stats in routes.items():
+      merge_route_stats(totals.setdefault(route, new_route_stats()), stats)
+    shared[key] = totals
+  memcache.set_multi(shared, time=(STATS_WINDOW + 1) * STATS_BUCKET)
+
+# log_slow_request()
+# @param route String
+# @param path String
+# @param elapsed Float
+# @param calls Dictionary
+# function adds a request with its call breakdown to the slow request log
+
+def log_slow_request(route, path, elapsed, calls):
+  log = memcache.get('stats-slow') or []
+  log.insert(0, {
+      'time': datetime.now(),
+      'route': route,
+      'path': path,
+      'ms': int(elapsed * 1000),
+      'calls': [(category, calls[category][0], int(calls[category][1] * 1000))
+                for category in STATS_CATEGORIES if category in calls]
+  })
+  memcache.set('stats-slow', log[:SLOW_REQUEST_LOG_SIZE])
+
+# get_stats()
+# @return Array
+# function returns the totals of the last STATS_WINDOW buckets per route,
+# slowest total time first
+
+def get_stats():
+  bucket = int(time.time() // STATS_BUCKET)
+  keys = ['stats-%d' % b for b in range(bucket - STATS_WINDOW + 1, bucket + 1)]
+  buckets = memcache.get_multi(keys).values()
+  pending_stats_lock.acquire()
+  try:
+    # totals of this instance that are not flushed yet
+    buckets = list(buckets) + list(pending_stats['buckets'].values())
+  finally:
+    pending_stats_lock.release()
+
+  totals = {}
+  for routes in buckets:
+    for route, stats in routes.items():
+      merge_route_stats(totals.setdefault(route, new_route_stats()), stats)
+
+  results = []
+  for route, stats in totals.items():
+    requests = stats['requests']
+    calls = []
+    for category in STATS_CATEGORIES:
+      count, seconds = stats['calls'].get(category, (0, 0.0))
+      calls.append({
+          'name': category,
+          'count': round(float(count) / requests, 1),
+          'ms': round(seconds * 1000 / requests, 1)
+      })
+    results.append({
+        'route': route,
+        'requests': requests,
+        'seconds': round(stats['seconds'], 2),
+        'average': round(stats['seconds'] * 1000 / requests, 1),
+        'p50': histogram_percentile(stats['histogram'], 0.5),
+        'p95': histogram_percentile(stats['histogram'], 0.95),
+        'histogram': stats['histogram'],
+        'calls': calls
+    })
+  results.sort(key=lambda route: -route['seconds'])
+  return results
+
+# histogram_percentile()
+# @param histogram Array
+# @param fraction Float
+# @return String
+# function returns the histogram bucket holding the given percentile, as
+# its upper bound in ms
+
+def histogram_percentile(histogram, fraction):
+  needed = fraction * sum(histogram)
+  seen = 0
+  for i, count in enumerate(histogram):
+    seen += count
+    if count and seen >= needed:
+      return i < len(STATS_HISTOGRAM) and '%d' % STATS_HISTOGRAM[i] or '>%d' % STATS_HISTOGRAM[-1]
+  return '-'
+
+HTTP_DATE_FORMAT = '%a, %d %b %Y %H:%M:%S GMT'
+
+# http_date()
+# @param dt datetime
+# @return String
+# function formats an UTC datetime for HTTP headers
+
+def http_date(dt):
+  return dt.strftime(HTTP_DATE_FORMAT)
+
+# parse_http_date()
+# @param value String
+# @return datetime
+# function parses a HTTP date header, returns None for missing or malformed values
+
+def parse_http_date(value):
+  try:
+    return datetime.strptime(value.split(';')[0].strip(), HTTP_DATE_FORMAT)
+  except:
+    return None
+
+# not_modified()
+# @param self Object
+# @param etag String
+# @param modified datetime
+# @return Boolean
+# function sets the ETag and Last-Modified headers and answers with
+# 304 Not Modified if the copy the client already has is still fresh
+
+def not_modified(self, etag, modified):
+  self.response.headers['ETag'] = etag
+  self.response.headers['Last-Modified'] = http_date(modified)
+
+  if_none_match = self.request.headers.get('If-None-Match')
+  if if_none_match:
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    fresh = etag in tags or '*' in tags
+  else:
+    since = parse_http_date(self.request.headers.get('If-Modified-Since', ''))
+    fresh = since is not None and modified.replace(microsecond=0) <= since
+
+  if fresh:
+    self.response.set_status(304)
+    self.response.clear()
+  return fresh
+
+# Response compression
+# Pages, the feed and downloads are sent gzip (or brotli, when the brotli
+# module is installed) compressed to clients that accept it. Compressed
+# variants are cached by the ETag of the content, so each version of a
+# response is compressed only once
+
+MIN_COMPRESS_SIZE = 1024 # smaller bodies are sent as they are
+MAX_VARIANT_SIZE = 900000 # variants are cached in memcache, keep them within its value limit
+MAX_COMPRESS_FILE_SIZE = 1024*1024 # files are joined in memory to compress them
+PRECOMPRESSED_EXTENSIONS = frozenset('7z avi bz2 docx gif gz jpeg jpg mov mp3 mp4 ogg png pptx rar tgz webm xlsx zip'.split())
+
+_brotli = None
+
+# brotli_api()
+# @return Module
+# function returns the brotli module, None if it is not installed
+
+def brotli_api():
+  global _brotli
+  if _brotli is None:
+    try:
+      import brotli
+      _brotli = brotli
+    except ImportError:
+      _brotli = False
+  return _brotli or None
+
+# accepted_encoding()
+# @param request Object
+# @return String
+# function returns the best content encoding the client accepts ('br' or
+# 'gzip'), None if it only takes uncompressed responses
+
+def accepted_encoding(request):
+  accepted = {}
+  for part in request.headers.get('Accept-Encoding', '').split(','):
+    name, _, params = part.partition(';')
+    quality = 1.0
+    params = params.strip()
+    if params.startswith('q='):
+      try:
+        quality = float(params[2:])
+      except ValueError:
+        quality = 0.0
+    accepted[name.strip().lower()] = quality
+
+  if accepted.get('br', 0) > 0 and brotli_api():
+    return 'br'
+  if accepted.get('gzip', accepted.get('*', 0)) > 0:
+    return 'gzip'
+  return None
+
+# compress()
+# @param data String
+# @param encoding String
+# @return String
+# function compresses data with the given content encoding
+
+def compress(data, encoding):
+  if isinstance(data, unicode):
+    data = data.encode('utf-8')
+  if encoding == 'br':
+    return brotli_api().compress(data)
+
+  import gzip
+  from cStringIO import StringIO
+  buffer = StringIO()
+  stream = gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=6)
+  stream.write(data)
+  stream.close()
+  return buffer.getvalue()
+
+# compressed_variant()
+# @param self Object
+# @param etag String
+# @param load Function
+# @return Tuple
+# function picks the encoding of a response from the Accept-Encoding header
+# and returns the ETag of the variant with the compressed body (None if the
+# body is sent uncompressed). load() returns the uncompressed body and is
+# only called when the variant is not cached yet
+
+def compressed_variant(self, etag, load):
+  self.response.headers['Vary'] = 'Accept-Encoding'
+  encoding = accepted_encoding(self.request)
+  if not encoding:
+    return etag, None
+
+  key = 'variant-%s-%s' % (encoding, text_digest(etag))
+  data = cache_get(key)
+  if data is None:
+    body = load()
+    if isinstance(body, unicode):
+      body = body.encode('utf-8')
+    data = False
+    if len(body) >= MIN_COMPRESS_SIZE:
+      data = compress(body, encoding)
+      # not worth it if it saves less than a tenth
+      if len(data) > MAX_VARIANT_SIZE or len(data) > len(body) * 0.9:
+        data = False
+    cache_set(key, data)
+
+  if not data:
+    return etag, None
+  self.response.headers['Content-Encoding'] = encoding
+  return '%s-%s"' % (etag[:-1], encoding), data
 
 # error_404()
 # @param self Object
@@ -160,66 +1079,1522 @@ def error_404(self):
     'links': get_links()
   }
   
+  self.response.out.write(render_site_template(site_prefs, template_values))
+
+# Compiled custom templates, keyed by the md5 hash of the template source.
+# The cache lives as long as the instance, so a custom template is parsed
+# once per instance instead of once per request
+TEMPLATE_CACHE_SIZE = 4
+template_cache = {}
+template_cache_warm = False
+
+# get_custom_template()
+# @param text String
+# @return django.template.Template
+# function returns the compiled custom template, parsing the source only if
+# it is not already in the template cache. Returns None for broken templates
+
+def get_custom_template(text):
+  if isinstance(text, unicode):
+    text = text.encode('utf-8')
+  digest = text_digest(text)
+  if digest in template_cache:
+    return template_cache[digest]
   try:
-    if not site_prefs['templateDefault'] and len(site_prefs['templateText'].strip()):
-      self.response.out.write(Template(site_prefs['templateText']).render(path, template_values))
-      return
+    compiled = Template(text)
   except:
-    pass
+    logging.debug('Template error')
+    compiled = None
+  if len(template_cache) >= TEMPLATE_CACHE_SIZE:
+    template_cache.clear()
+  template_cache[digest] = compiled
+  return compiled
+
+# warm_template_cache()
+# @param site_prefs Array
+# function compiles the current custom template (if any) so the first
+# request served by an instance doesn't have to
+
+def warm_template_cache(site_prefs=None):
+  global template_cache_warm
+  template_cache_warm = True
+  try:
+    site_prefs = site_prefs or get_site_prefs()
+    if not site_prefs.get('templateDefault', False) and site_prefs.get('templateText', False):
+      get_custom_template(site_prefs['templateText'])
+  except:
+    logging.debug('Could not warm template cache')
+
+# render_site_template()
+# @param site_prefs Array
+# @param template_values Array
+# @return String
+# function renders the site layout, the custom template from the site
+# settings if there is one, the bundled views/base.html otherwise
+
+def render_site_template(site_prefs, template_values):
+  if not site_prefs.get('templateDefault', False) and site_prefs.get('templateText', False):
+    t = get_custom_template(site_prefs['templateText'])
+    if t:
+      try:
+        return timed('template', t.render)(Context(template_values))
+      except:
+        logging.debug('Template error')
   path = os.path.join(os.path.dirname(__file__), 'views/base.html')
-  self.response.out.write(template.render(path, template_values))
+  return template.render(path, template_values)
 
 
+# url_key()
+# @param url String
+# @return db.Key
+# function returns the key of the PageUrl row for an url
+
+def url_key(url):
+  return db.Key.from_path('PageUrl', 'url:%s' % url)
+
+# index_page_url()
+# @param page db.Object
+# function adds a saved page to the url index
+
+def index_page_url(page):
+  PageUrl(key_name='url:%s' % page.url, page=page).put()
+
+# ensure_migrated()
+# @param name String
+# @param migrate Function
+# function runs a one-off data migration unless it has already run for
+# this site. Completed migrations are recorded in the Setting table
+
+def ensure_migrated(name, migrate):
+  if migrated(name):
+    return
+  migrate()
+  s = Setting()
+  s.name = name
+  s.value = '1'
+  s.put()
+  cache_set('migrated-%s' % name, True)
+
+# migrated()
+# @param name String
+# @return Boolean
+# function checks if a one-off data migration has run for this site
+
+def migrated(name):
+  if cache_get('migrated-%s' % name):
+    return True
+  if Setting.all().filter('name =', name).get():
+    cache_set('migrated-%s' % name, True)
+    return True
+  return False
+
+# build_url_index()
+# function fills the url index with all existing pages
+
+def build_url_index():
+  query = Page.all()
+  pages = query.fetch(200)
+  while pages:
+    db.put([PageUrl(key_name='url:%s' % page.url, page=page) for page in pages if page.url])
+    query.with_cursor(query.cursor())
+    pages = query.fetch(200)
+
+# ensure_url_index()
+# function indexes the pages created before the url index existed
+
+def ensure_url_index():
+  ensure_migrated('url_index', build_url_index)
+
 # get_page()
 # @param url String
 # @return db.Object
-# function takes url identifier and retrieves corresponding row from the database
+# function takes url identifier and retrieves corresponding row from the database.
+# The key of the page is cached separately from the page, so a page that
+# dropped out of the cache is loaded with a single get. Until the url index
+# is built (by a background task) pages are found with a query
 
 def get_page(url):
-  page = memcache.get("page-%s" % url)
+  if not url:
+    return False
+  page = cache_get("page-%s" % url)
   if page is None:
     page = False
-    query = db.GqlQuery("SELECT * FROM Page WHERE url = :1", url)
-    for p in query:
-      page = p
-      memcache.set("page-%s" % url, page)
+    if not migrated('url_index'):
+      if memcache.add('migrating-url_index', True, LEASE_TIME * 6):
+        enqueue_task('build-url-index')
+      page = Page.all().filter('url =', url).get() or False
+    else:
+      key = cache_get("url-%s" % url)
+      if key:
+        page = db.get(db.Key(key))
+        if page and page.url != url:
+          page = False
+      if not page:
+        entry = db.get(url_key(url))
+        try:
+          page = entry and entry.page or False
+        except db.Error:
+          # the index points to a page that doesn't exist anymore
+          page = False
+        if page:
+          cache_set("url-%s" % url, str(page.key()))
+    if page:
+      cache_set("page-%s" % url, page)
   return page
 
 # get_unique_url()
 # @param url String
 # @return String
 # function takes in an url and checks if it's already used.
-# If the url already exists then adds a number to the end of the url
+# If the url already exists then adds a number to the end of the url.
+# Candidates are checked against the url index in batches
+
+URL_CANDIDATE_BATCH = 10
 
 def get_unique_url(url):
+  ensure_url_index()
   nr = 0
-  t_url = url
-  page = get_page(url)
-  while page:
-    nr += 1
-    t_url = "%s-%s" % (url, nr)
-    page = get_page(t_url)
-  return t_url
+  while True:
+    candidates = [n and "%s-%s" % (url, n) or url for n in range(nr, nr + URL_CANDIDATE_BATCH)]
+    entries = db.get([url_key(candidate) for candidate in candidates])
+    for candidate, entry in zip(candidates, entries):
+      if entry is None:
+        return candidate
+    nr += URL_CANDIDATE_BATCH
+
+SUBPAGES_PER_PAGE = 20
+SUBPAGE_SUMMARY_WORDS = 30
+
+# node_key()
+# @param page_key db.Key
+# @return db.Key
+# function returns the key of the page tree node of a page
+
+def node_key(page_key):
+  return db.Key.from_path('PageNode', str(page_key))
+
+# make_page_node()
+# @param page db.Object
+# @param ancestors Array
+# @return db.Object
+# function creates (but doesn't save) the tree node of a page
+
+def make_page_node(page, ancestors):
+  return PageNode(key_name=str(page.key()),
+                  owner=Page.owner.get_value_for_datastore(page),
+                  ancestors=ancestors,
+                  title=page.title,
+                  url=page.url,
+                  draft=page.draft,
+                  created=page.created,
+                  summary=truncate_html_words(page.body() or u'', SUBPAGE_SUMMARY_WORDS))
+
+# update_page_node()
+# @param page db.Object
+# function updates the tree node of a saved page. If the page got a new
+# owner, the ancestor paths of its descendants are updated as well
+
+def update_page_node(page):
+  page_tree_ready() # nodes written before the build are rewritten by it
+  owner_key = Page.owner.get_value_for_datastore(page)
+  ancestors = []
+  if owner_key:
+    owner_node = db.get(node_key(owner_key))
+    ancestors = (owner_node and owner_node.ancestors or []) + [owner_key]
+
+  node = db.get(node_key(page.key()))
+  moved = node and node.ancestors != ancestors
+  make_page_node(page, ancestors).put()
+
+  if moved:
+    query = PageNode.all()
+    query.filter('ancestors =', page.key())
+    descendants = query.fetch(200)
+    while descendants:
+      for descendant in descendants:
+        path = descendant.ancestors
+        descendant.ancestors = ancestors + path[path.index(page.key()):]
+      db.put(descendants)
+      query.with_cursor(query.cursor())
+      descendants = query.fetch(200)
+
+# update_page_nodes()
+# @param pages Array
+# function updates the tree nodes of several saved pages. Nodes of pages
+# that kept their owner are written with one put, moved pages go through
+# update_page_node()
+
+def update_page_nodes(pages):
+  page_tree_ready()
+  nodes = db.get([node_key(page.key()) for page in pages])
+  kept = []
+  for page, node in zip(pages, nodes):
+    if node and PageNode.owner.get_value_for_datastore(node) == Page.owner.get_value_for_datastore(page):
+      kept.append(make_page_node(page, node.ancestors))
+    else:
+      update_page_node(page)
+  db.put(kept)
+
+# build_page_tree()
+# function creates the tree nodes for all existing pages and caches the
+# menu collected from the same pages, a query on the new nodes might not
+# see all of them yet. The pages are read twice, only the owner of every
+# page is kept in memory between the batches
+
+def build_page_tree():
+  owners = {}
+  query = Page.all()
+  batch = query.fetch(200)
+  while batch:
+    for page in batch:
+      owners[page.key()] = Page.owner.get_value_for_datastore(page)
+    query.with_cursor(query.cursor())
+    batch = query.fetch(200)
+
+  links = []
+  query = Page.all()
+  batch = query.fetch(200)
+  while batch:
+    nodes = []
+    for page in batch:
+      ancestors = []
+      owner = Page.owner.get_value_for_datastore(page)
+      if not owner and not page.draft:
+        links.append({'title':page.title,'url':page.url,'key':str(page.key())})
+      while owner and owner not in ancestors:
+        ancestors.insert(0, owner)
+        owner = owners.get(owner)
+      nodes.append(make_page_node(page, ancestors))
+    db.put(nodes)
+    query.with_cursor(query.cursor())
+    batch = query.fetch(200)
+  links.sort(key=lambda link: link['title'])
+  cache_set('site-links', links)
+
+# ensure_page_tree()
+# function creates the page tree for pages saved before it existed
+
+def ensure_page_tree():
+  ensure_migrated('page_tree', build_page_tree)
+
+# migrate_page_tree()
+# function builds the page tree in a background task, the pages rendered
+# from the fallback queries in the meantime are dropped from the cache
+
+def migrate_page_tree():
+  if not migrated('page_tree'):
+    ensure_page_tree()
+    bump_generation()
+
+# page_tree_ready()
+# @return Boolean
+# function checks if the page tree is built. If not, building it is started
+# in the background (unless it already runs) and the callers use the
+# fallback queries on the pages, like get_page() does for the url index
+
+def page_tree_ready():
+  if migrated('page_tree'):
+    return True
+  if memcache.add('migrating-page_tree', True, LEASE_TIME * 6):
+    enqueue_task('build-page-tree')
+  return False
+
+TREE_FALLBACK_LIMIT = 1000
+
+# fallback_page_nodes()
+# @param owner db.Key
+# @param draft Boolean
+# @param order String
+# @return Array
+# function creates unsaved tree nodes (without ancestor paths) for the pages
+# under the owner while the page tree is being built, sorted in memory by
+# the order property ('-' for descending). Only equality filters are used
+# so the query needs no composite index
+
+def fallback_page_nodes(owner, draft=None, order='title'):
+  query = Page.all()
+  query.filter('owner =', owner)
+  if draft is not None:
+    query.filter('draft =', draft)
+  nodes = [make_page_node(page, []) for page in query.fetch(TREE_FALLBACK_LIMIT)]
+  nodes.sort(key=lambda node: getattr(node, order.lstrip('-')), reverse=order.startswith('-'))
+  return nodes
+
+# fallback_ancestors()
+# @param page db.Object
+# @return Array
+# function loads the owner chain of a page (top level page first) while the
+# page tree is being built
+
+def fallback_ancestors(page):
+  ancestors = []
+  owner = Page.owner.get_value_for_datastore(page)
+  while owner and owner not in [ancestor.key() for ancestor in ancestors]:
+    ancestor = db.get(owner)
+    if not ancestor:
+      break
+    ancestors.insert(0, ancestor)
+    owner = Page.owner.get_value_for_datastore(ancestor)
+  return ancestors
+
+# get_page_tree()
+# @param page db.Object
+# @param cursor String
+# @return Array
+# function retrieves the breadcrumbs of a page together with one page of
+# its published subpages (newest first) and the cursor to the next page
+
+def get_page_tree(page, cursor=None):
+  cache_key = 'subtree-%s-%s-%s' % (get_generation(), str(page.key()), cursor and text_digest(cursor) or '')
+  tree = cache_get(cache_key)
+  if tree is None:
+    if page_tree_ready():
+      node = db.get(node_key(page.key()))
+      ancestors = []
+      if node and node.ancestors:
+        ancestors = db.get([node_key(key) for key in node.ancestors])
+
+      query = PageNode.all()
+      query.filter('owner =', page.key())
+      query.filter('draft =', False)
+      query.order('-created')
+      try:
+        if cursor:
+          query.with_cursor(cursor)
+        children = query.fetch(SUBPAGES_PER_PAGE)
+      except:
+        return None
+      next_cursor = len(children) == SUBPAGES_PER_PAGE and query.cursor() or None
+    else:
+      # the newest subpages only, until the tree is built
+      ancestors = fallback_ancestors(page)
+      children = fallback_page_nodes(page.key(), False, '-created')[:SUBPAGES_PER_PAGE]
+      next_cursor = None
+    breadcrumbs = [{'title': ancestor.title, 'url': ancestor.url}
+                   for ancestor in ancestors if ancestor and not ancestor.draft]
+
+    tree = {
+        'breadcrumbs': breadcrumbs,
+        'subpages': [{
+            'key': child.key().name(),
+            'title': child.title,
+            'url': child.url,
+            'created': child.created,
+            'summary': child.summary,
+            'content': child.summary # name used by custom templates from older versions
+        } for child in children],
+        'cursor': next_cursor
+    }
+    cache_set(cache_key, tree)
+  return tree
 
 # get_links()
 # @return Array
 # function retrieves alphabetically sorted list of active pages for the site menu
 
 def get_links():
-  links = memcache.get('site-links')
-  if links is None:
-    links = []
-    site_prefs = get_site_prefs()
-    query = Page.all()
-    query.order("title")
-    pages = query.fetch(1000)
-    for page in pages:
-      if not page.draft and not page.owner and (not site_prefs['front'] or site_prefs['front']!=page.url):
-        links.append({'title':page.title,'url':page.url,'key':str(page.key())})
+  front = get_site_prefs()['front']
+  return [link for link in get_menu_index() if not front or link['url'] != front]
+
+# get_menu_index()
+# @return Array
+# function retrieves the menu index, all published top level pages sorted by
+# title. The entries are stored one per row as the page tree nodes of those
+# pages, the list itself is only kept in the cache
 
-    memcache.set("site-links", links)
+def get_menu_index():
+  return cache_get_or_build('site-links', build_menu_index)
+
+# build_menu_index()
+# @return Array
+# function creates the menu index from the page tree, or from the pages
+# while the tree is being built
+
+def build_menu_index():
+  if not page_tree_ready():
+    return [{'title':node.title,'url':node.url,'key':node.key().name()}
+            for node in fallback_page_nodes(None, False)]
+  links = []
+  query = PageNode.all()
+  query.filter('owner =', None)
+  query.filter('draft =', False)
+  query.order('title')
+  nodes = query.fetch(200)
+  while nodes:
+    for node in nodes:
+      links.append({'title':node.title,'url':node.url,'key':node.key().name()})
+    query.with_cursor(query.cursor())
+    nodes = query.fetch(200)
   return links
 
+# update_menu()
+# @param pages db.Object or Array
+# @param removed Boolean
+# @return Boolean
+# function checks if saving, publishing, unpublishing or removing pages
+# changed the menu and caches the updated menu if it did, returns True if
+# the menu changed. The tree nodes of the pages must be up to date
+
+def update_menu(pages, removed=False):
+  if not isinstance(pages, list):
+    pages = [pages]
+  keys = set([str(page.key()) for page in pages])
+  listed = [page for page in pages
+            if not removed and not page.draft and not Page.owner.get_value_for_datastore(page)]
+
+  links = get_menu_index()
+  kept = [link for link in links if link['key'] not in keys]
+  if listed:
+    kept.extend([{'title':page.title,'url':page.url,'key':str(page.key())} for page in listed])
+    kept.sort(key=lambda link: link['title'])
+  changed = kept != links
+  if changed:
+    # a query on the tree nodes might not see the pages just saved yet
+    cache_set("site-links", kept)
+  return changed
+
+
+SEARCH_WORD = re.compile(r'\w+', re.UNICODE)
+HTML_ENTITY = re.compile(r'&(#?)(x?)(\w+);')
+SEARCH_STOPWORDS = frozenset(u'a an and are as at be but by for from has have in is it its of on or that the this to was were will with'.split())
+SEARCH_TITLE_WEIGHT = 3
+SEARCH_MAX_TERMS = 1000 # keeps the index rows of a page within datastore limits
+SEARCH_MAX_RESULTS = 200
+SEARCH_RESULTS_PER_PAGE = 10
+
+# unescape_entities()
+# @param text String
+# @return String
+# function replaces HTML entities (TinyMCE stores accented letters as named entities) with the characters
+
+def unescape_entities(text):
+  def replace(match):
+    hash, hex, name = match.groups()
+    try:
+      if hash:
+        return unichr(int(name, hex and 16 or 10))
+      return unichr(name2codepoint[name])
+    except:
+      return u' '
+  return HTML_ENTITY.sub(replace, text)
+
+# tokenize()
+# @param text String
+# @return Array
+# function splits the text of a page (HTML allowed) into lowercase search terms
+
+def tokenize(text):
+  text = unescape_entities(HTML_TAG.sub(u' ', text or u''))
+  return [word for word in SEARCH_WORD.findall(text.lower()) if len(word) > 1 and word not in SEARCH_STOPWORDS]
+
+# index_page()
+# @param page db.Object
+# function adds a published page to the search index or removes a draft from it
+
+def index_page(page):
+  index_pages([page])
+
+# index_pages()
+# @param pages Array
+# function updates the search index for several pages with one put and one delete
+
+def index_pages(pages):
+  db.put([make_search_entry(page) for page in pages if not page.draft])
+  db.delete([db.Key.from_path('SearchEntry', str(page.key())) for page in pages if page.draft])
+
+# make_search_entry()
+# @param page db.Object
+# @return db.Object
+# function creates (but doesn't save) the search index row of a page
+
+def make_search_entry(page):
+  frequencies = {}
+  words = tokenize(page.content)
+  for word in words:
+    frequencies[word] = frequencies.get(word, 0) + 1
+  for word in tokenize(page.title):
+    frequencies[word] = frequencies.get(word, 0) + SEARCH_TITLE_WEIGHT
+
+  terms = frequencies.keys()
+  if len(terms) > SEARCH_MAX_TERMS:
+    terms = sorted(terms, key=lambda term: frequencies[term], reverse=True)[:SEARCH_MAX_TERMS]
+    frequencies = dict([(term, frequencies[term]) for term in terms])
+
+  return SearchEntry(key_name=str(page.key()),
+                     terms=list(terms),
+                     frequencies=json.dumps(frequencies),
+                     length=len(words),
+                     title=page.title,
+                     url=page.url,
+                     summary=make_excerpt(page.excerpt or page.content, SUBPAGE_SUMMARY_WORDS))
+
+# search_pages()
+# @param text String
+# @return Array
+# function finds the published pages containing all the words of the
+# search text, best matches first
+
+def search_pages(text):
+  terms = []
+  for term in tokenize(text):
+    if term not in terms:
+      terms.append(term)
+  terms = terms[:5]
+  if not terms:
+    return []
+
+  cache_key = 'search-%s-%s' % (get_generation(), text_digest(u' '.join(terms)))
+  results = cache_get(cache_key)
+  if results is None:
+    query = SearchEntry.all()
+    for term in terms:
+      query.filter('terms =', term)
+    # every match is scored, only the best SEARCH_MAX_RESULTS are kept
+    ranked = []
+    count = 0
+    entries = query.fetch(200)
+    while entries:
+      for entry in entries:
+        frequencies = json.loads(entry.frequencies)
+        # frequent terms score higher, long pages get damped
+        score = sum([1 + math.log(frequencies.get(term, 1)) for term in terms]) / math.log(entry.length + math.e)
+        count += 1
+        result = (score, -count, {'title': entry.title, 'url': entry.url, 'summary': entry.summary})
+        if len(ranked) < SEARCH_MAX_RESULTS:
+          heapq.heappush(ranked, result)
+        elif result[:2] > ranked[0][:2]:
+          heapq.heapreplace(ranked, result)
+      query.with_cursor(query.cursor())
+      entries = query.fetch(200)
+    ranked.sort(reverse=True)
+    results = [result for score, order, result in ranked]
+    cache_set(cache_key, results)
+  return results
+
+MAX_UPLOAD_SIZE = 10*1024*1024 # also bounds the buffered download response, see MediaHandler
+MAX_IMAGE_SIZE = 1024*1024 # the images API doesn't take anything larger
+MEDIA_CHUNK_SIZE = 900*1024
+CONTENT_DIGEST = re.compile(r'^[0-9a-f]{40}$')
+IMMUTABLE_MAX_AGE = 365*24*60*60
+
+# blob_parent()
+# @param media db.Object
+# @return db.Key
+# function returns the key the payload of a media entity (chunks, image
+# sizes and derivatives) is stored under. Uploads are stored by their
+# digest, so identical uploads share one payload, uploads from older
+# versions keep theirs under the media entity
+
+def blob_parent(media):
+  if media.digest:
+    return db.Key.from_path('MediaContent', 'sha1-%s' % media.digest)
+  return media.key()
+
+# file_digest()
+# @param stream File
+# @return String
+# function returns the sha1 hex digest of a seekable file, reading it a
+# chunk at a time, and rewinds the file
+
+def file_digest(stream):
+  digest = hashlib.sha1()
+  while True:
+    data = stream.read(MEDIA_CHUNK_SIZE)
+    if not data:
+      break
+    digest.update(data)
+  stream.seek(0)
+  return digest.hexdigest()
+
+# find_content()
+# @param digest String
+# @return db.Object
+# function returns a media entity holding the content with the digest,
+# processed ones first, None if there is none
+
+def find_content(digest):
+  query = Media.all()
+  query.filter('digest =', digest)
+  found = None
+  for media in query.fetch(10):
+    if media.status == 'OK':
+      return media
+    found = found or media
+  return found
+
+# share_content()
+# @param media db.Object
+# @param source db.Object
+# function makes a media entity use the stored content of another one
+# with the same digest, nothing is copied
+
+def share_content(media, source):
+  media.type = source.type
+  media.width = source.width
+  media.height = source.height
+  media.size = source.size
+  media.chunks = source.chunks
+  media.chunk_size = source.chunk_size
+  media.status = source.status
+
+# get_media()
+# @param key String
+# @return db.Object
+# function returns a media entity by its key or, for the content addressed
+# urls, by its digest. Content is only found by digest once it's processed
+
+def get_media(key):
+  if CONTENT_DIGEST.match(key):
+    media = find_content(key)
+    return media and media.status == 'OK' and media or None
+  try:
+    return Media.get(key)
+  except:
+    return None
+
+# chunk_key()
+# @param parent db.Key
+# @param index Integer
+# @return db.Key
+# function returns the key of the chunk with the given index
+
+def chunk_key(parent, index):
+  return db.Key.from_path('MediaChunk', 'c%d' % index, parent=parent)
+
+# media_blob_key()
+# @param parent db.Key
+# @param size String
+# @return db.Key
+# function returns the key of a stored image size ('full' or 'thumb')
+
+def media_blob_key(parent, size):
+  return db.Key.from_path('MediaBlob', size, parent=parent)
+
+# store_media_chunks()
+# @param media db.Object
+# @param stream File
+# function writes the uploaded file as chunks while reading it from the
+# stream, the media entity must be saved before to get a key
+
+def store_media_chunks(media, stream):
+  parent = blob_parent(media)
+  index = 0
+  size = 0
+  while True:
+    data = stream.read(MEDIA_CHUNK_SIZE)
+    if not data:
+      break
+    MediaChunk(parent=parent, key_name='c%d' % index, data=db.Blob(data)).put()
+    index += 1
+    size += len(data)
+  media.chunks = index
+  media.chunk_size = MEDIA_CHUNK_SIZE
+  media.size = size
+  media.put()
+
+# get_media_info()
+# @param key String
+# @return Array
+# function retrieves the metadata of a media entity needed to serve its
+# payload, without the payload itself
+
+def get_media_info(key):
+  info = cache_get('media_%s' % key)
+  if info is None:
+    media = get_media(key)
+    if media:
+      info = {
+          'key': str(media.key()),
+          'digest': media.digest,
+          'blobs': str(blob_parent(media)),
+          'name': media.name,
+          'type': media.type,
+          'size': media.size or 0,
+          'chunks': media.chunks or 0,
+          'chunk_size': media.chunk_size or 0,
+          'uploaded': media.uploaded
+      }
+    else:
+      info = False
+    cache_set('media_%s' % key, info)
+  return info
+
+# MissingMediaData
+# Raised by read_media() when the payload described by the media info is
+# gone, like after the upload was deleted or processed by another instance
+
+class MissingMediaData(Exception):
+  pass
+
+# read_media()
+# @param info Array
+# @param start Integer
+# @param end Integer
+# @return Generator
+# function yields the bytes start..end (inclusive) of a media payload one
+# chunk at a time
+
+def read_media(info, start, end):
+  parent = db.Key(info['blobs'])
+  if not info['chunks']:
+    blob = db.get(media_blob_key(parent, 'full'))
+    if blob:
+      data = blob.data
+    else:
+      # uploads from older versions that are not moved to MediaBlob yet
+      media = Media.get(info['key'])
+      if not media or media.file is None:
+        raise MissingMediaData(info['key'])
+      data = media.file
+    yield data[start:end+1]
+    return
+  size = info['chunk_size']
+  for index in range(start // size, end // size + 1):
+    chunk = db.get(chunk_key(parent, index))
+    if chunk is None:
+      raise MissingMediaData(info['key'])
+    offset = index * size
+    yield chunk.data[max(start - offset, 0):end - offset + 1]
+
+# delete_media()
+# @param media db.Object
+# function removes a media entity together with its payload, unless other
+# uploads with the same digest still use it
+
+def delete_media(media):
+  keys = [media.key()]
+  if media.digest:
+    # the cached info of the content url may point to this row
+    cache_delete('media_%s' % media.digest)
+    query = Media.all()
+    query.filter('digest =', media.digest)
+    others = [other for other in query.fetch(100) if other.key() != media.key()]
+    if others:
+      db.delete(keys)
+      waiting = [other for other in others if other.status == 'PROCESSING']
+      if media.status == 'PROCESSING' and waiting:
+        # only this row was queued for processing, the waiting uploads of
+        # the same content would never be updated
+        enqueue_task('process-upload', key=str(waiting[0].key()))
+      return
+    for size in ('full', 'thumb') + IMAGE_DERIVATIVE_SIZES:
+      cache_delete('image_%s_%s' % (size, media.digest))
+  parent = blob_parent(media)
+  keys += [chunk_key(parent, i) for i in range(media.chunks or 0)]
+  keys += [media_blob_key(parent, size) for size in ('full', 'thumb')]
+  keys += [derivative_key(parent, size) for size in IMAGE_DERIVATIVE_SIZES]
+  # width derivatives stored by older versions under the plain size name
+  keys += [db.Key.from_path('MediaDerivative', size, parent=parent) for size in IMAGE_DERIVATIVE_SIZES
+           if size.startswith('w')]
+  db.delete(keys)
+
+# media_summary()
+# @param media db.Object
+# @return Array
+# function returns what the editor shows of a media entity
+
+def media_summary(media):
+  return {
+    'width': media.width or 0,
+    'height': media.height or 0,
+    'type': media.type,
+    'key': str(media.key()),
+    'address': media.digest or str(media.key()), # key of the /image/ and /download/ urls
+    'name': media.name,
+    'status': media.status or 'OK',
+    'size': media.size or 0,
+    'description': media.description or u''
+  }
+
+# process_upload()
+# @param key String
+# function turns a raw upload into an image (resized to 800x600 at most,
+# with a thumbnail) if the images API can read it, otherwise it stays a file.
+# Waiting uploads with the same digest get the result without another
+# transform
+
+def process_upload(key):
+  media = Media.get(key)
+  if not media or media.status != 'PROCESSING':
+    return
+
+  source = media.digest and find_content(media.digest)
+  if source and source.status == 'OK':
+    # an identical upload was processed in the meantime
+    share_content(media, source)
+    media.put()
+    cache_delete('media_%s' % key)
+    cache_delete('media-list')
+    return
+
+  parent = blob_parent(media)
+  chunks = [chunk_key(parent, i) for i in range(media.chunks or 0)]
+  data = ''.join([chunk.data for chunk in db.get(chunks) if chunk])
+  if len(data) != media.size:
+    # the shared chunks were already turned into an image for an identical
+    # upload, never mark this row as a file without its chunks
+    source = media.digest and find_content(media.digest)
+    if source and source.status == 'OK':
+      share_content(media, source)
+      media.put()
+      cache_delete('media_%s' % key)
+    else:
+      logging.warning('Chunks of upload %s are incomplete' % key)
+    return
+
+  thumbnail = None
+  try:
+    images = images_api()
+    img = images.Image(data)
+    width = img.width
+    height = img.height
+    if width>800 or height>600:
+      img.resize(width=800, height=600)
+    img.im_feeling_lucky()
+    full = img.execute_transforms(output_encoding=images.JPEG)
+
+    img = images.Image(full)
+    media.width = img.width
+    media.height = img.height
+    img.resize(width=80, height=60)
+    img.im_feeling_lucky()
+    thumbnail = img.execute_transforms(output_encoding=images.JPEG)
+  except Exception:
+    # not an image (images.Error) or no images service, like a local server
+    # without the stub. The raw chunks are the file, the row must not stay
+    # PROCESSING
+    if _images is None or not isinstance(sys.exc_info()[1], _images.Error):
+      logging.exception('Upload %s is stored as a file, the images API failed' % key)
+  if thumbnail is None:
+    media.status = 'OK'
+    media.put()
+  else:
+    db.put([MediaBlob(key_name='full', parent=parent, data=db.Blob(full)),
+            MediaBlob(key_name='thumb', parent=parent, data=db.Blob(thumbnail))])
+    media.type = 'IMAGE'
+    media.size = len(full)
+    media.chunks = 0
+    media.chunk_size = None
+    media.status = 'OK'
+    media.put()
+    db.delete(chunks)
+
+  twins = []
+  if media.digest:
+    query = Media.all()
+    query.filter('digest =', media.digest)
+    twins = [twin for twin in query.fetch(100) if twin.status == 'PROCESSING' and twin.key() != media.key()]
+    for twin in twins:
+      share_content(twin, media)
+    db.put(twins)
+    # the content urls may have been requested while processing
+    cache_delete('media_%s' % media.digest)
+    for size in ('full', 'thumb') + IMAGE_DERIVATIVE_SIZES:
+      cache_delete('image_%s_%s' % (size, media.digest))
+
+  for item in [media] + twins:
+    cache_delete('media_%s' % item.key())
+  cache_delete('media-list')
+
+# Background tasks
+# Work that doesn't have to finish within the request (like processing
+# uploads) is run by name from TASKS. On App Engine the tasks go to the
+# task queue (see queue.yaml for the number of parallel workers), with the
+# local backends to a pool of TURBINE_WORKERS threads in this process
+
+TASKS = {
+    'process-upload': process_upload,
+    'build-url-index': ensure_url_index,
+    'build-page-tree': migrate_page_tree
+}
+TASK_QUEUE = 'uploads'
+LOCAL_WORKERS = int(os.environ.get('TURBINE_WORKERS', 2))
+
+# LocalTaskQueue
+# In-process stand-in for the task queue, tasks are run by a pool of
+# daemon threads with a request cache of their own
+
+class LocalTaskQueue(object):
+  def __init__(self, workers=LOCAL_WORKERS):
+    try:
+      import Queue as queue
+    except ImportError:
+      import queue
+    self.tasks = queue.Queue()
+    for i in range(max(1, workers)):
+      worker = threading.Thread(target=self.work, name='turbine-worker-%d' % i)
+      worker.setDaemon(True)
+      worker.start()
+
+  def add(self, name, params):
+    self.tasks.put((name, params))
+
+  def work(self):
+    while True:
+      name, params = self.tasks.get()
+      begin_request()
+      try:
+        try:
+          TASKS[name](**params)
+        except:
+          logging.exception('Task %s failed' % name)
+      finally:
+        end_request()
+
+local_task_queue = None
+local_task_queue_lock = threading.Lock()
+
+# enqueue_task()
+# @param name String
+# @param params Array
+# function schedules the task with the given name to run in the background
+
+def enqueue_task(name, **params):
+  global local_task_queue
+  if os.environ.get('TURBINE_STORAGE') == 'sqlite':
+    local_task_queue_lock.acquire()
+    try:
+      if local_task_queue is None:
+        local_task_queue = LocalTaskQueue()
+    finally:
+      local_task_queue_lock.release()
+    local_task_queue.add(name, params)
+    return
+
+  try:
+    from google.appengine.api import taskqueue
+  except ImportError:
+    from google.appengine.api.labs import taskqueue
+  taskqueue.add(url='/admin/tasks/%s' % name, params=params, queue_name=TASK_QUEUE)
+
+BYTE_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# parse_range()
+# @param value String
+# @param size Integer
+# @return Tuple
+# function parses a single range Range header into a (start, end) tuple.
+# Returns None if the whole file should be sent and False if the range
+# can't be satisfied
+
+def parse_range(value, size):
+  match = BYTE_RANGE.match((value or '').strip())
+  if not match or match.groups() == ('', ''):
+    return None
+  first, last = match.groups()
+  if first:
+    start = int(first)
+    end = size - 1
+    if last:
+      end = min(int(last), size - 1)
+  else:
+    start = max(size - int(last), 0)
+    end = size - 1
+    if not int(last):
+      return False
+  if start > end:
+    return False
+  return (start, end)
+
+
+# Sizes ImageHandler generates derivatives for, besides the stored 'full'
+# and 'thumb' sizes. 'wN' fits the image to N pixels width, 'WxH' into a
+# WxH box. Only these are accepted so the derivative store can't be flooded
+IMAGE_DERIVATIVE_SIZES = ('w160', 'w320', 'w480', 'w640', '160x120', '320x240', '480x360', '640x480')
+IMAGE_SRCSET_WIDTHS = [160, 320, 480, 640]
+MAX_DERIVATIVES = 2000
+DERIVATIVE_TOUCH_INTERVAL = timedelta(days=1)
+DERIVATIVE_EVICT_INTERVAL = 10*60 # seconds between eviction runs
+
+# derivative_key()
+# @param parent db.Key
+# @param size String
+# @return db.Key
+# function returns the key of a stored derivative size
+
+def derivative_key(parent, size):
+  return db.Key.from_path('MediaDerivative', 's%s' % size, parent=parent)
+
+# media_variant()
+# @param media db.Object
+# @param size String
+# @return String
+# function returns the bytes of a stored image size ('full' or 'thumb')
+
+def media_variant(media, size):
+  blob = db.get(media_blob_key(blob_parent(media), size))
+  if blob:
+    return blob.data
+  # uploads from older versions that are not moved to MediaBlob yet
+  if size == 'full':
+    return media.file
+  return media.thumbnail
+
+# move_media_blobs()
+# function moves the data of uploads from older versions out of the Media
+# rows, images into MediaBlob rows and files into a single MediaChunk row.
+# A few rows at a time as each can hold up to 1 MB
+
+def move_media_blobs():
+  query = Media.all()
+  batch = query.fetch(10)
+  while batch:
+    blobs = []
+    moved = []
+    for media in batch:
+      if media.file is None and media.thumbnail is None:
+        continue
+      parent = blob_parent(media)
+      media.size = media.size or len(media.file or '')
+      if media.type == 'IMAGE':
+        blobs.append(MediaBlob(key_name='full', parent=parent, data=media.file))
+        blobs.append(MediaBlob(key_name='thumb', parent=parent, data=media.thumbnail))
+      elif media.file:
+        blobs.append(MediaChunk(key_name='c0', parent=parent, data=media.file))
+        media.chunks = 1
+        media.chunk_size = len(media.file)
+      media.file = None
+      media.thumbnail = None
+      moved.append(media)
+    if moved:
+      db.put(blobs)
+      db.put(moved)
+      for media in moved:
+        cache_delete('media_%s' % media.key())
+    query.with_cursor(query.cursor())
+    batch = query.fetch(10)
+  cache_delete('media-list')
+
+# ensure_media_blobs()
+# function makes sure the Media rows hold metadata only
+
+def ensure_media_blobs():
+  ensure_migrated('media_blobs', move_media_blobs)
+
+TASKS['move-media-blobs'] = ensure_media_blobs
+
+# queue_media_blobs()
+# function starts the move of the upload data from older versions in the
+# background, unless it is done or already running. Until then the data is
+# read from the Media rows
+
+def queue_media_blobs():
+  if not migrated('media_blobs') and memcache.add('migrating-media_blobs', True, LEASE_TIME * 6):
+    enqueue_task('move-media-blobs')
+
+# derivative_box()
+# @param size String
+# @return Tuple
+# function converts a derivative size into a (width, height) tuple, height
+# is 0 for width-only sizes
+
+def derivative_box(size):
+  if size.startswith('w'):
+    return (int(size[1:]), 0)
+  width, height = size.split('x')
+  return (int(width), int(height))
+
+# get_derivative()
+# @param media db.Object
+# @param size String
+# @return String
+# function returns the image resized to one of IMAGE_DERIVATIVE_SIZES. The
+# image is transformed only on the first request for a size, after that the
+# result is read from the derivative store
+
+def get_derivative(media, size):
+  key = derivative_key(blob_parent(media), size)
+  derivative = db.get(key)
+  if derivative:
+    if derivative.accessed < datetime.utcnow() - DERIVATIVE_TOUCH_INTERVAL:
+      derivative.accessed = datetime.utcnow()
+      derivative.put()
+    return derivative.data
+
+  data = media_variant(media, 'full')
+  if not data:
+    return None
+  width, height = derivative_box(size)
+  if width < media.width or (height and height < media.height):
+    # width-only sizes get a height that never limits the resize
+    images = images_api()
+    data = images.resize(data, width=width, height=height or 4000, output_encoding=images.JPEG)
+
+  MediaDerivative(key_name=key.name(), parent=key.parent(), data=db.Blob(data)).put()
+  # eviction runs in the background at most every DERIVATIVE_EVICT_INTERVAL
+  if memcache.add('evict-derivatives', True, DERIVATIVE_EVICT_INTERVAL):
+    enqueue_task('evict-derivatives')
+  return data
+
+# evict_derivatives()
+# function removes the least recently accessed derivatives above
+# MAX_DERIVATIVES, run as a background task
+
+def evict_derivatives():
+  query = MediaDerivative.all(keys_only=True)
+  query.order('-accessed')
+  stale = query.fetch(100, offset=MAX_DERIVATIVES)
+  while stale:
+    db.delete(stale)
+    stale = query.fetch(100, offset=MAX_DERIVATIVES)
+
+TASKS['evict-derivatives'] = evict_derivatives
+
+# Import and export
+# The site is exported as a line-delimited archive, one json record per
+# line: Setting, Media (with a MediaData record per payload chunk or image
+# size) and Page records, in that order. Entities are read a batch at a
+# time with cursors, so the export never holds more than one batch and
+# one payload chunk. Imported entities get the key name IMPORT_PREFIX +
+# the exported key, which makes importing the same record twice write the
+# same entity, and owner references and media urls in the content are
+# remapped to those keys. The importer records how far it got per
+# archive, importing the archive again continues from there
+
+ARCHIVE_VERSION = 1
+EXPORT_BATCH = 100
+IMPORT_BATCH = 100
+IMPORT_BATCH_SIZE = 4*1024*1024 # bytes of records written with one put
+IMPORT_TIME_BUDGET = 20 # seconds an import request runs before it pauses
+IMPORT_PREFIX = 'imp-'
+IMPORT_SKIPPED_SETTINGS = frozenset(['site_links', 'url_index', 'page_tree', 'media_blobs']) # rebuilt, not copied ('site_links' is from older versions)
+MEDIA_URL = re.compile(r'(/(?:image/[\w-]+|download)/)([\w-]+)/')
+PAGE_URL = re.compile(r'(/page/)([^"\'?#<>\s]+)')
+
+# encode_datetime()
+# @param dt datetime
+# @return String
+# function converts a datetime into the archive format (ISO 8601)
+
+def encode_datetime(dt):
+  return dt and dt.isoformat() or None
+
+# decode_datetime()
+# @param value String
+# @return datetime
+# function converts an archive date back into a datetime
+
+def decode_datetime(value):
+  if not value:
+    return None
+  value, _, fraction = value.partition('.')
+  dt = datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+  return dt.replace(microsecond=int((fraction or '0').ljust(6, '0')[:6]))
+
+# export_records()
+# @return Generator
+# function yields the records of the whole site, paging through the
+# entities with cursors
+
+def export_records():
+  yield {'kind': 'Archive', 'version': ARCHIVE_VERSION, 'exported': encode_datetime(datetime.utcnow())}
+  queue_media_blobs()
+  for model, export in ((Setting, export_setting), (Media, export_media), (Page, export_page)):
+    query = model.all()
+    batch = query.fetch(EXPORT_BATCH)
+    while batch:
+      for entity in batch:
+        for record in export(entity):
+          yield record
+      query.with_cursor(query.cursor())
+      batch = query.fetch(EXPORT_BATCH)
+
+# write_archive()
+# @param out File
+# function writes the export archive to a file-like object
+
+def write_archive(out):
+  for record in export_records():
+    out.write(json.dumps(record))
+    out.write('\n')
+
+# export_setting()
+# @param setting db.Object
+# @return Generator
+# function yields the record of a Setting row
+
+def export_setting(setting):
+  yield {'kind': 'Setting', 'key': str(setting.key()), 'name': setting.name, 'value': setting.value}
+
+# export_page()
+# @param page db.Object
+# @return Generator
+# function yields the record of a page, the owner as its exported key
+
+def export_page(page):
+  owner = Page.owner.get_value_for_datastore(page)
+  yield {
+    'kind': 'Page',
+    'key': str(page.key()),
+    'title': page.title,
+    'url': page.url,
+    'content': page.content,
+    'draft': page.draft,
+    'owner': owner and str(owner) or None,
+    'created': encode_datetime(page.created),
+    'edited': encode_datetime(page.edited)
+  }
+
+# export_media()
+# @param media db.Object
+# @return Generator
+# function yields the record of a media entity followed by its payload,
+# one chunk or image size per record, base64 encoded
+
+def export_media(media):
+  key = str(media.key())
+  yield {
+    'kind': 'Media',
+    'key': key,
+    'name': media.name,
+    'type': media.type,
+    'description': media.description,
+    'width': media.width,
+    'height': media.height,
+    'uploaded': encode_datetime(media.uploaded),
+    'size': media.size,
+    'chunks': media.chunks or 0,
+    'chunk_size': media.chunk_size,
+    'status': media.status,
+    'digest': media.digest
+  }
+  parent = blob_parent(media)
+  for index in range(media.chunks or 0):
+    chunk = db.get(chunk_key(parent, index))
+    if chunk:
+      yield {'kind': 'MediaData', 'media': key, 'name': 'c%d' % index, 'data': base64.b64encode(chunk.data)}
+  if not media.chunks:
+    for size in ('full', 'thumb'):
+      data = media_variant(media, size)
+      if data:
+        yield {'kind': 'MediaData', 'media': key, 'name': size, 'data': base64.b64encode(data)}
+
+# import_key()
+# @param kind String
+# @param key String
+# @return db.Key
+# function returns the key an exported entity is imported under
+
+def import_key(kind, key):
+  return db.Key.from_path(kind, IMPORT_PREFIX + key)
+
+# remap_media_urls()
+# @param content String
+# @return String
+# function points the /image/ and /download/ urls of page content to the
+# imported media
+
+def remap_media_urls(content):
+  def remap(match):
+    try:
+      key = db.Key(match.group(2))
+    except:
+      return match.group(0)
+    if key.kind() != 'Media':
+      return match.group(0)
+    return '%s%s/' % (match.group(1), import_key('Media', match.group(2)))
+  return MEDIA_URL.sub(remap, content or u'')
+
+# import_archive()
+# @param stream File
+# @param deadline Float
+# @return Array
+# function imports an archive from a seekable file. Records are written a
+# batch at a time and the position after each batch is saved, so when the
+# deadline (a time.time() value) passes or the request dies, importing the
+# same archive again continues after the last written batch. Returns the
+# progress with done set once the archive is fully imported
+
+def import_archive(stream, deadline=None):
+  name = 'import:%s' % file_digest(stream)
+
+  progress = Setting.get_by_key_name(name)
+  state = progress and json.loads(progress.value) or {'offset': 0, 'records': 0, 'site_prefs': None, 'urls': {}}
+  stream.seek(state['offset'])
+
+  records = []
+  size = 0
+  while True:
+    line = stream.readline()
+    if line.strip():
+      records.append(json.loads(line))
+      size += len(line)
+    if line and len(records) < IMPORT_BATCH and size < IMPORT_BATCH_SIZE:
+      continue
+    import_records(records, state)
+    state['offset'] = stream.tell()
+    state['records'] += len(records)
+    Setting(key_name=name, name=name, value=json.dumps(state)).put()
+    records = []
+    size = 0
+    if not line:
+      break
+    if deadline and time.time() > deadline:
+      state['done'] = False
+      return state
+
+  # within a request the rebuild of the derived data runs as a task
+  if deadline:
+    enqueue_task('finish-import', name=name, host=request_host())
+  else:
+    finish_import(name)
+  state['done'] = True
+  return state
+
+# import_records()
+# @param records Array
+# @param state Array
+# function writes a batch of archive records with one put. The site
+# preferences are kept in the import state and applied at the end
+
+def import_records(records, state):
+  entities = []
+  pages = []
+  media = {}
+  for record in records:
+    kind = record.get('kind')
+    if kind == 'Setting':
+      if record['name'] == 'site_prefs':
+        state['site_prefs'] = json.loads(record['value'])
+      elif record['name'] not in IMPORT_SKIPPED_SETTINGS and not record['name'].startswith('import:'):
+        key = import_key('Setting', record['key'])
+        existing = Setting.all().filter('name =', record['name']).get()
+        if not existing or existing.key() == key:
+          entities.append(Setting(key_name=key.name(), name=record['name'], value=record['value']))
+    elif kind == 'Media':
+      item = Media(key_name=IMPORT_PREFIX + record['key'],
+                   name=record['name'],
+                   type=record['type'],
+                   description=record['description'],
+                   width=record['width'],
+                   height=record['height'],
+                   uploaded=decode_datetime(record['uploaded']),
+                   size=record['size'],
+                   chunks=record['chunks'],
+                   chunk_size=record['chunk_size'],
+                   status=record['status'] or 'OK',
+                   digest=record.get('digest'))
+      media[record['key']] = item
+      entities.append(item)
+    elif kind == 'MediaData':
+      item = media.get(record['media']) or db.get(import_key('Media', record['media']))
+      if not item:
+        continue
+      media[record['media']] = item
+      model = record['name'].startswith('c') and MediaChunk or MediaBlob
+      entities.append(model(key_name=record['name'], parent=blob_parent(item),
+                            data=db.Blob(base64.b64decode(record['data']))))
+    elif kind == 'Page':
+      page = Page(key_name=IMPORT_PREFIX + record['key'],
+                  title=record['title'],
+                  url=record['url'],
+                  content=db.Text(remap_media_urls(record['content'])),
+                  draft=record['draft'],
+                  owner=record['owner'] and import_key('Page', record['owner']) or None,
+                  created=decode_datetime(record['created']))
+      preprocess_page(page)
+      pages.append(page)
+
+  if pages:
+    resolve_import_urls(pages, state)
+    entities.extend(pages)
+    entities.extend([PageUrl(key_name='url:%s' % page.url, page=page) for page in pages if page.url])
+  db.put(entities)
+  if pages:
+    index_pages(pages)
+  for page in pages:
+    cache_delete("page-%s" % page.url)
+  for key in media:
+    cache_delete('media_%s' % import_key('Media', key))
+
+# resolve_import_urls()
+# @param pages Array
+# @param state Array
+# function gives imported pages whose url is taken by another page an
+# unused one. Pages written by an earlier run keep the url they got then.
+# Changed urls are recorded in the import state (archived url -> new url)
+
+def resolve_import_urls(pages, state):
+  ensure_url_index()
+  existing = db.get([page.key() for page in pages])
+  entries = db.get([url_key(page.url) for page in pages])
+  for page, old, entry in zip(pages, existing, entries):
+    archived = page.url
+    if old:
+      page.url = old.url
+    elif entry and PageUrl.page.get_value_for_datastore(entry) != page.key():
+      page.url = get_unique_url(page.url)
+    if page.url != archived:
+      state.setdefault('urls', {})[archived] = page.url
+
+# remap_page_urls()
+# @param urls Array
+# function points the /page/ links in the content of the imported pages to
+# the new urls of renamed pages
+
+def remap_page_urls(urls):
+  def remap(match):
+    return match.group(1) + urls.get(match.group(2), match.group(2))
+
+  query = Page.all()
+  batch = query.fetch(100)
+  while batch:
+    changed = []
+    for page in batch:
+      if not page.key().name() or not page.key().name().startswith(IMPORT_PREFIX):
+        continue
+      content = PAGE_URL.sub(remap, page.content or u'')
+      if content != page.content:
+        page.content = db.Text(content)
+        preprocess_page(page)
+        changed.append(page)
+    if changed:
+      db.put(changed)
+      index_pages(changed)
+      for page in changed:
+        cache_delete("page-%s" % page.url)
+    query.with_cursor(query.cursor())
+    batch = query.fetch(100)
+
+# finish_import()
+# @param name String
+# function remaps the links to renamed pages, rebuilds the page tree and
+# menu for the imported pages, queues uploads that were still being
+# processed and applies the imported site preferences (which also bumps
+# the content generation). Runs as a task after an import request, the
+# snapshot of the feed links to the host the import was sent to
+
+def finish_import(name, host=None):
+  if host:
+    request_state.host = host
+  progress = Setting.get_by_key_name(name)
+  if not progress:
+    return
+  state = json.loads(progress.value)
+  urls = state.get('urls') or {}
+  site_prefs = state['site_prefs']
+  if urls:
+    remap_page_urls(urls)
+    if site_prefs and site_prefs.get('front') in urls:
+      site_prefs['front'] = urls[site_prefs['front']]
+
+  build_page_tree()
+
+  query = Media.all()
+  query.filter('status =', 'PROCESSING')
+  for media in query.fetch(200):
+    enqueue_task('process-upload', key=str(media.key()))
+  cache_invalidate('feed')
+  cache_delete('media-list')
+
+  prefs = get_site_prefs()
+  prefs.update(site_prefs or {})
+  if not set_site_prefs(prefs):
+    bump_generation()
+    refresh_snapshots(everything=True)
+  db.delete(progress.key())
+
+TASKS['finish-import'] = finish_import
 
 ########################### VIEW HANDLERS ###########################
 
@@ -229,125 +2604,654 @@ def get_links():
 class PageHandler(webapp.RequestHandler):
   def get(self, url=False):
     
+    # Everything a page view may need from the cache, in one round trip
+    cursor = self.request.get('after') or None
+    keys = ['site-prefs', 'site-links', 'migrated-url_index', 'migrated-page_tree',
+            'snapshot-%s' % snapshot_name(url)]
+    if url:
+      keys += ['page-%s' % url, page_cache_key(url, cursor)]
+    prefetch(keys)
+
     #Load site prefs
     site_prefs = get_site_prefs()
+
+    # In snapshot mode the first listing page is served as pre-rendered
+    snapshot = site_prefs['snapshots'] and not cursor and get_snapshot(snapshot_name(url))
+    if snapshot:
+      return self.write_rendered(snapshot)
     
     if not url and site_prefs['front']:
       url = site_prefs['front']
+      prefetch(['page-%s' % url, page_cache_key(url, cursor)])
     
-    # Load current page
-    page = get_page(url)
-    
-    if page:
-      # Load subpages
-      subpages = memcache.get('subpage-%s' % str(page.key()))
-      if subpages is None:
-        q = Page.all()
-        q.filter("owner =", page)
-        q.order("-created")
-        subpages = q.fetch(1000)
-        memcache.set('subpage-%s' % str(page.key()), subpages)
-    
-    if not page or page.draft:
+    # Rendered pages are cached per content generation, any change to the
+    # pages, menu or site settings moves the site to a new generation. While
+    # a page is rendered again, the rendering of the previous generation is
+    # served to the other visitors. Missing pages are cached as False
+    def build():
+      body = render_page(url, site_prefs, cursor)
+      return body is not None and make_rendered(body)
+    rendered = cache_get_or_build(page_cache_key(url, cursor), build,
+                                  page_cache_key(url, cursor, get_generation() - 1))
+    if not rendered:
       return error_404(self)
 
-    #Render page
-    template_values = {
-        'site_title': site_prefs['title'],
-        'description': site_prefs['description'],
-        'page':page,
-        'subpages': subpages,
-        'links': get_links()
-    }
+    self.write_rendered(rendered)
 
-    try:
-      if not site_prefs.get('templateDefault',False) and site_prefs.get('templateText', False):
-        t = Template(site_prefs['templateText'].encode('utf-8'))
-        c = Context(template_values)
-        tmpl = t.render(c)
-        self.response.out.write(tmpl)
-        return
-    except:
-      logging.debug('Template error')
-      pass
-    path = os.path.join(os.path.dirname(__file__), 'views/base.html')
-    self.response.out.write(template.render(path, template_values))
+  def write_rendered(self, rendered):
+    self.response.headers['Cache-Control'] = 'public, max-age=0, must-revalidate'
+    etag, data = compressed_variant(self, rendered['etag'], lambda: rendered['body'])
+    if not_modified(self, etag, rendered['modified']):
+      return
+    self.response.out.write(data or rendered['body'])
+
+# page_cache_key()
+# @param url String
+# @param cursor String
+# @param generation Integer
+# @return String
+# function returns the cache key of a rendered page in the given generation
+# (the current one by default)
+
+def page_cache_key(url, cursor=None, generation=None):
+  if generation is None:
+    generation = get_generation()
+  return 'html-%s-%s' % (generation, text_digest(u'%s?%s' % (url or '', cursor or '')))
+
+# render_page()
+# @param url String
+# @param site_prefs Array
+# @param cursor String
+# @return String
+# function renders a CMS page with its subpages, returns None if the page
+# doesn't exist or is not published
+
+def render_page(url, site_prefs, cursor=None):
+  # Load current page
+  page = get_page(url)
+  
+  if not page or page.draft:
+    return None
+
+  # Load breadcrumbs and subpages
+  tree = get_page_tree(page, cursor)
+  if tree is None:
+    return None
+
+  #Render page
+  template_values = {
+      'site_title': site_prefs['title'],
+      'description': site_prefs['description'],
+      'page':page,
+      'breadcrumbs': tree['breadcrumbs'],
+      'subpages': tree['subpages'],
+      'next_subpages': tree['cursor'],
+      'links': get_links()
+  }
+
+  return render_site_template(site_prefs, template_values)
+
+# make_rendered()
+# @param body String
+# @param etag String
+# @param modified datetime
+# @return Array
+# function wraps a rendered response body for the cache
+
+def make_rendered(body, etag=None, modified=None):
+  return {
+      'body': body,
+      'etag': etag or '"%s"' % text_digest(body),
+      'modified': modified or datetime.utcnow()
+  }
+
+# snapshot_name()
+# @param url String
+# @return String
+# function returns the snapshot key name of a page url, 'front' for the front page
+
+def snapshot_name(url):
+  return url and 'page:%s' % url or 'front'
+
+# get_snapshot()
+# @param name String
+# @return Array
+# function retrieves a pre-rendered view (body, etag and modified), None if
+# there is no snapshot of it
+
+def get_snapshot(name):
+  snapshot = cache_get('snapshot-%s' % name)
+  if snapshot is None:
+    s = Snapshot.get_by_key_name(name)
+    snapshot = s and make_rendered(s.body, s.etag, s.modified) or False
+    cache_set('snapshot-%s' % name, snapshot)
+  return snapshot or None
+
+# snapshot_urls()
+# @param page db.Object
+# @param old_owner db.Key
+# @param renamed Boolean
+# @return Array
+# function returns the urls of the pages showing a saved page: the page,
+# its owner (and the previous owner if it moved) and, when its title or
+# owner changed, the descendants that have it in their breadcrumbs
+
+def snapshot_urls(page, old_owner=None, renamed=False):
+  owners = [key for key in (Page.owner.get_value_for_datastore(page), old_owner) if key]
+  urls = [page.url] + [owner.url for owner in db.get(owners) if owner]
+  if renamed:
+    query = PageNode.all()
+    query.filter('ancestors =', page.key())
+    urls += [node.url for node in query]
+  return urls
+
+# refresh_snapshots()
+# @param urls Array
+# @param everything Boolean
+# function renders the snapshots of the given pages, or of every published
+# page when the menu, the template or the site settings changed, together
+# with the front page and the feed. Snapshots of pages that are not
+# published anymore are removed. Does nothing unless the site is in snapshot
+# mode. Call after bump_generation() so no stale renderings are reused.
+# The feed links use the given host, the host of the request by default
+
+def refresh_snapshots(urls=(), everything=False, host=None):
+  site_prefs = get_site_prefs()
+  if not site_prefs['snapshots']:
+    return
+
+  urls = set(urls)
+  if everything:
+    # the pages themselves while the tree is being built
+    query = page_tree_ready() and PageNode.all() or Page.all()
+    query.filter('draft =', False)
+    batch = query.fetch(200)
+    while batch:
+      urls.update([node.url for node in batch])
+      query.with_cursor(query.cursor())
+      batch = query.fetch(200)
+
+  rendered = {}
+  removed = []
+  for url in urls:
+    body = render_page(url, site_prefs)
+    if body is None:
+      removed.append(snapshot_name(url))
+    else:
+      rendered[snapshot_name(url)] = make_rendered(body)
+  front = site_prefs['front']
+  if front and snapshot_name(front) in rendered:
+    rendered['front'] = rendered[snapshot_name(front)]
+  elif everything or front in urls:
+    removed.append('front')
+  feed = render_feed(site_prefs, host or request_host())
+  rendered['feed'] = make_rendered(feed['body'], feed['etag'], feed['modified'])
+
+  snapshots = [Snapshot(key_name=name, body=db.Text(value['body']), etag=value['etag'],
+                        modified=value['modified']) for name, value in rendered.items()]
+  for i in range(0, len(snapshots), 100):
+    db.put(snapshots[i:i + 100])
+  if removed:
+    db.delete([db.Key.from_path('Snapshot', name) for name in removed])
+  for name, value in rendered.items():
+    cache_set('snapshot-%s' % name, value)
+  for name in removed:
+    cache_set('snapshot-%s' % name, False)
+
+# save_pages()
+# @param pages Array
+# @param old_owners Dictionary
+# function saves changed pages and brings the page tree, menu, feed,
+# search index and caches up to date for all of them at once, with a
+# single generation bump. old_owners maps the keys of moved pages to
+# their previous owners
+
+def save_pages(pages, old_owners={}):
+  db.put(pages)
+  update_page_nodes(pages)
+  menu_changed = update_menu(pages)
+  update_feed(pages)
+  index_pages(pages)
+  for page in pages:
+    cache_set("page-%s" % page.url, page)
+  bump_generation()
+
+  urls = []
+  for page in pages:
+    moved = page.key() in old_owners
+    urls.extend(snapshot_urls(page, old_owners.get(page.key()), moved))
+  refresh_snapshots(urls, everything=menu_changed)
+
+# remove_pages()
+# @param pages Array
+# function deletes pages with their url index, tree and search index rows
+# and updates the menu, feed and caches once for all of them
+
+def remove_pages(pages):
+  update_feed(pages, removed=True)
+  keys = []
+  for page in pages:
+    keys.extend([url_key(page.url), node_key(page.key()),
+                 db.Key.from_path('SearchEntry', str(page.key())), page.key()])
+  db.delete(keys)
+  for page in pages:
+    cache_delete("page-%s" % page.url)
+  menu_changed = update_menu(pages, removed=True)
+  bump_generation()
+
+  urls = []
+  for page in pages:
+    urls.extend(snapshot_urls(page))
+  refresh_snapshots(urls, everything=menu_changed)
+
+# clear_snapshots()
+# function removes all snapshots when snapshot mode is turned off
+
+def clear_snapshots():
+  query = Snapshot.all(keys_only=True)
+  keys = query.fetch(200)
+  while keys:
+    db.delete(keys)
+    for key in keys:
+      cache_delete('snapshot-%s' % key.name())
+    keys = query.fetch(200)
 
 
 # FeedHandler
-# Handler for RSS feed, displays the last 10 added pages
+# Handler for RSS feed, displays the last added pages (10 by default, see
+# the feedItems site setting)
 
 class FeedHandler(webapp.RequestHandler):
   def get(self, url=False):
     
+    prefetch(['site-prefs', 'feed', 'snapshot-feed'])
+
     #Load site prefs
     site_prefs = get_site_prefs()
 
-    # Sat, 08 Aug 2009 12:57:53 +0000
-    fmt = '%a, %d %b %Y %H:%M:%S +0000'
-
-    items = memcache.get('feed')
-    if items is None:
-      items = []
-      query = db.GqlQuery("SELECT * FROM Page WHERE draft = :1 ORDER BY created DESC", False)
-      for page in query:
-        item = {
-            'title':page.title,
-            'content': page.content,
-            'url': page.url,
-            'date':page.created.strftime(fmt)
-        }
-        items.append(item)
-      memcache.set('feed',items)
+    feed = site_prefs['snapshots'] and get_snapshot('feed') or render_feed(site_prefs, self.request.host)
 
-    if len(items):
-      pubdate = items[0]['date']
-    else:
-      pubdate = datetime.utcnow().strftime(fmt)
+    self.response.headers['Content-Type'] = 'application/rss+xml; Charset=utf-8'
+    data = None
+    if feed['etag']:
+      self.response.headers['Cache-Control'] = 'public, max-age=0, must-revalidate'
+      etag, data = compressed_variant(self, feed['etag'], lambda: feed['body'])
+      if not_modified(self, etag, feed['modified']):
+        return
+    self.response.out.write(data or feed['body'])
+
+# render_feed()
+# @param site_prefs Array
+# @param host String
+# @return Array
+# function renders the RSS feed with links to the given host, returns the body with the etag and the
+# modification time of the newest item (both None for an empty feed)
+
+def render_feed(site_prefs, host):
+  items = get_feed_items(site_prefs)
+
+  etag = modified = None
+  if len(items):
+    pubdate = items[0]['date']
+    modified = max([max(item['created'], item['edited']) for item in items])
+    # compressed variants are cached by this etag, so it covers everything shown
+    etag = '"%s"' % text_digest(u'%s|%s|%s|%s' % (site_prefs['title'], site_prefs['description'],
+        site_prefs.get('feedExcerpts'), u','.join([u'%s:%s' % (item['key'], item['edited']) for item in items])))
+  else:
+    pubdate = datetime.utcnow().strftime(FEED_DATE_FORMAT)
+
+  template_values = {
+      'title': site_prefs['title'],
+      'description': site_prefs['description'],
+      'domain':host,
+      'pubdate': pubdate,
+      'items':items
+  }
+
+  path = os.path.join(os.path.dirname(__file__), 'views/feed.html')
+  return {
+      'body': template.render(path, template_values),
+      'etag': etag,
+      'modified': modified
+  }
+
+# Sat, 08 Aug 2009 12:57:53 +0000
+FEED_DATE_FORMAT = '%a, %d %b %Y %H:%M:%S +0000'
+FEED_EXCERPT_WORDS = 50
+HTML_TAG = re.compile(r'<[^>]*>')
+
+# make_excerpt()
+# @param html String
+# @param words Integer
+# @return String
+# function strips the markup from html and shortens it to the given number of words
+
+def make_excerpt(html, words=FEED_EXCERPT_WORDS):
+  parts = HTML_TAG.sub(' ', html or u'').split()
+  if len(parts) > words:
+    return u' '.join(parts[:words]) + u'...'
+  return u' '.join(parts)
+
+HTML_COMMENT = re.compile(r'<!--(?!\[if).*?-->', re.DOTALL) # conditional comments are kept
+HTML_PRESERVED = re.compile(r'<(pre|textarea|script|style)\b.*?</\1\s*>', re.DOTALL | re.IGNORECASE)
+HTML_SPACE = re.compile(r'\s+')
+HTML_EMPTY_EDGES = re.compile(r'^(?:<p>(?:\s|&nbsp;|<br\s*/?>)*</p>\s*)+|(?:\s*<p>(?:\s|&nbsp;|<br\s*/?>)*</p>)+$', re.IGNORECASE)
+IMAGE_REFERENCE = re.compile(r'/image/[\w-]+/([\w-]+)/')
+
+# minify_html()
+# @param html String
+# @return String
+# function normalizes the HTML from the editor: comments and the empty
+# paragraphs TinyMCE leaves at the ends are dropped, and runs of whitespace
+# are collapsed except inside pre, textarea, script and style elements
+
+def minify_html(html):
+  html = HTML_COMMENT.sub(u'', html or u'')
+  parts = []
+  position = 0
+  for match in HTML_PRESERVED.finditer(html):
+    parts.append(HTML_SPACE.sub(u' ', html[position:match.start()]))
+    parts.append(match.group(0))
+    position = match.end()
+  parts.append(HTML_SPACE.sub(u' ', html[position:]))
+  return HTML_EMPTY_EDGES.sub(u'', u''.join(parts).strip())
+
+# preprocess_page()
+# @param page db.Object
+# function fills the fields derived from the content of a page (html,
+# excerpt, word_count, image_keys), to be called before the page is saved
+
+def preprocess_page(page):
+  html = minify_html(page.content)
+  page.html = db.Text(html)
+  page.excerpt = db.Text(make_excerpt(html))
+  page.word_count = len(unescape_entities(HTML_TAG.sub(u' ', html)).split())
+  keys = []
+  for key in IMAGE_REFERENCE.findall(html):
+    if key not in keys:
+      keys.append(key)
+  page.image_keys = keys
+
+# feed_item()
+# @param page db.Object
+# @param site_prefs Array
+# @return Array
+# function converts a page into a feed item
+
+def feed_item(page, site_prefs):
+  return {
+      'key': str(page.key()),
+      'title': page.title,
+      'content': site_prefs.get('feedExcerpts') and (page.excerpt or make_excerpt(page.content)) or page.body(),
+      'url': page.url,
+      'date': page.created.strftime(FEED_DATE_FORMAT),
+      'created': page.created,
+      'edited': page.edited or page.created
+  }
+
+# feed_limit()
+# @param site_prefs Array
+# @return Integer
+# function returns the maximum number of items in the feed
+
+def feed_limit(site_prefs):
+  try:
+    return max(1, int(site_prefs.get('feedItems', 10)))
+  except:
+    return 10
+
+# get_feed_items()
+# @param site_prefs Array
+# @return Array
+# function retrieves the newest published pages as feed items, newest first
+
+def get_feed_items(site_prefs):
+  def build():
+    query = Page.all()
+    query.filter("draft =", False)
+    query.order("-created")
+    return [feed_item(page, site_prefs) for page in query.fetch(feed_limit(site_prefs))]
+  return cache_get_or_build('feed', build)
+
+# update_feed()
+# @param pages db.Object or Array
+# @param removed Boolean
+# function updates the cached feed after pages were saved, published,
+# unpublished or removed. Only the items of these pages are inserted,
+# replaced or dropped, the feed is not rebuilt
+
+def update_feed(pages, removed=False):
+  if not isinstance(pages, list):
+    pages = [pages]
+  items = shared_get('feed')
+  if items is None:
+    # nothing cached, the next reader builds the feed anyway
+    return
+
+  site_prefs = get_site_prefs()
+  limit = feed_limit(site_prefs)
+  keys = set([str(page.key()) for page in pages])
+  kept = [item for item in items if item['key'] not in keys]
+
+  added = [feed_item(page, site_prefs) for page in pages if not removed and not page.draft]
+  if added:
+    kept.extend(added)
+    kept.sort(key=lambda item: item['created'], reverse=True)
+  if len(items) >= limit and len(kept) < limit:
+    # items left a full feed, pull in the next older pages to fill the gap.
+    # The given pages are skipped, removed ones may not be deleted yet
+    query = Page.all()
+    query.filter("draft =", False)
+    query.order("-created")
+    if kept:
+      query.filter("created <", kept[-1]['created'])
+    for older in query.fetch(limit - len(kept) + len(keys)):
+      if str(older.key()) not in keys:
+        kept.append(feed_item(older, site_prefs))
+
+  cache_set('feed', kept[:limit])
+
+# SearchHandler
+# Full-text search over the published pages
+
+class SearchHandler(webapp.RequestHandler):
+  def get(self):
+    
+    #Load site prefs
+    site_prefs = get_site_prefs()
+
+    q = self.request.get('q').strip()
+    try:
+      page_nr = max(1, int(self.request.get('page')))
+    except:
+      page_nr = 1
+
+    results = search_pages(q)
+    offset = (page_nr - 1) * SEARCH_RESULTS_PER_PAGE
+
+    results_values = {
+        'q': q,
+        'query_string': urllib.quote(q.encode('utf-8')),
+        'results': results[offset:offset + SEARCH_RESULTS_PER_PAGE],
+        'previous': page_nr > 1 and page_nr - 1 or False,
+        'next': len(results) > offset + SEARCH_RESULTS_PER_PAGE and page_nr + 1 or False
+    }
+    path = os.path.join(os.path.dirname(__file__), 'views/search.html')
+    content = template.render(path, results_values)
 
     template_values = {
-        'title': site_prefs['title'],
+        'site_title': site_prefs['title'],
         'description': site_prefs['description'],
-        'domain':os.environ['HTTP_HOST'],
-        'pubdate': pubdate,
-        'items':items
+        'title': u'Search',
+        'content': content,
+        'page': {'title': u'Search', 'content': content, 'body': content},
+        'links': get_links()
     }
-    
-    self.response.headers['Content-Type'] = 'application/rss+xml; Charset=utf-8'
-
-    path = os.path.join(os.path.dirname(__file__), 'views/feed.html')
-    self.response.out.write(template.render(path, template_values))
-      
+    self.response.out.write(render_site_template(site_prefs, template_values))
 
 # AdminMainHandler
 # Main handler for the Admin section
-# Displays all pages as a list
+# Lists the pages under one owner (top level pages by default) sorted by
+# title, a page at a time, optionally only drafts or published pages
+
+PAGES_PER_DASHBOARD = 50
 
 class AdminMainHandler(webapp.RequestHandler):
   def get(self):
     #Load site prefs
     site_prefs = get_site_prefs()
-    
-    q = Page.all()
-    q.filter("owner =", None)
-    q.order("title")
-    pages = q.fetch(1000)
+
+    ready = page_tree_ready()
+    status = self.request.get('status')
+    owner = None
+    if self.request.get('owner'):
+      try:
+        if ready:
+          owner = db.get(node_key(db.Key(self.request.get('owner'))))
+        else:
+          page = db.get(db.Key(self.request.get('owner')))
+          owner = page and make_page_node(page, [ancestor.key() for ancestor in fallback_ancestors(page)])
+      except:
+        owner = None
+
+    if ready:
+      q = PageNode.all()
+      q.filter("owner =", owner and db.Key(owner.key().name()) or None)
+      if status in ('draft', 'published'):
+        q.filter("draft =", status == 'draft')
+      q.order("title")
+      cursor = self.request.get('cursor')
+      if cursor:
+        try:
+          q.with_cursor(cursor)
+        except:
+          cursor = None
+      nodes = q.fetch(PAGES_PER_DASHBOARD)
+      next_cursor = len(nodes) == PAGES_PER_DASHBOARD and q.cursor() or None
+    else:
+      # the first page only, until the tree is built
+      draft = None
+      if status in ('draft', 'published'):
+        draft = status == 'draft'
+      nodes = fallback_page_nodes(owner and db.Key(owner.key().name()) or None, draft)[:PAGES_PER_DASHBOARD]
+      next_cursor = None
+    pages = [{
+        'key': node.key().name(),
+        'title': node.title,
+        'url': node.url,
+        'draft': node.draft
+    } for node in nodes]
+
+    # pages the selection can be moved under, from the tree nodes: the
+    # owners above this level, the listed pages and the top level pages
+    targets = []
+    if owner and owner.ancestors:
+      targets.extend(db.get([node_key(key) for key in owner.ancestors]))
+    targets.extend([owner] + nodes)
+    move_targets = []
+    seen = set()
+    for target in targets:
+      if target and target.key().name() not in seen:
+        seen.add(target.key().name())
+        move_targets.append({'key': target.key().name(), 'title': target.title})
+    move_targets.extend([{'key': link['key'], 'title': link['title']} for link in get_menu_index()
+                         if link['key'] not in seen])
+
+    # the filters without the cursor, for the paging and bulk action links
+    filters = urllib.urlencode([(name, self.request.get(name)) for name in ('status', 'owner')
+                                if self.request.get(name)])
    
     #Render page
     template_values = {
         'site_title': site_prefs['title'],
         'description': site_prefs['description'],
         'pages': pages,
+        'status': status,
+        'owner': owner and {'key': owner.key().name(), 'title': owner.title,
+                            'parent': owner.ancestors and str(owner.ancestors[-1]) or ''},
+        'filters': filters,
+        'next_cursor': next_cursor,
         'links': get_links(),
+        'move_targets': move_targets,
         'logouturl': users.create_logout_url("/"),
         'removed': self.request.get('removed') and True or False,
+        'reindexed': self.request.get('reindexed') and True or False,
         'updated': self.request.get('updated') and True or False,
+        'bulk': self.request.get('bulk') or False,
+        'bulk_count': self.request.get('count') or 0,
+        'imported': self.request.get('imported') or False,
+        'paused': self.request.get('paused') and True or False,
         'saved': self.request.get('saved') and self.request.get('saved') or False,
         'front':site_prefs['front'] or False
     }
     path = os.path.join(os.path.dirname(__file__), 'views/dashboard.html')
     self.response.out.write(template.render(path, template_values))
 
+# AdminBulkHandler
+# Publishes, unpublishes, deletes or moves (under a new owner) the selected
+# pages. The datastore writes are batched and the caches are updated once
+# for the whole selection
+
+MAX_BULK_PAGES = 100
+
+class AdminBulkHandler(webapp.RequestHandler):
+  def post(self):
+    action = self.request.get('action')
+    keys = []
+    for key in self.request.get_all('key')[:MAX_BULK_PAGES]:
+      try:
+        key = db.Key(key)
+      except:
+        continue
+      if key.kind() == 'Page':
+        keys.append(key)
+    pages = [page for page in Page.get(keys) if page]
+
+    if pages and action in ('publish', 'unpublish'):
+      front = get_site_prefs()['front']
+      # the front page stays published
+      changed = [page for page in pages
+                 if page.draft != (action == 'unpublish') and not (action == 'unpublish' and page.url == front)]
+      for page in changed:
+        page.draft = action == 'unpublish'
+      if changed:
+        save_pages(changed)
+      pages = changed
+    elif pages and action == 'remove':
+      remove_pages(pages)
+    elif pages and action == 'move':
+      owner = None
+      ancestors = []
+      if self.request.get('owner'):
+        try:
+          owner = db.Key(self.request.get('owner'))
+          node = db.get(node_key(owner))
+        except:
+          node = None
+        if not node:
+          return error_404(self)
+        ancestors = node.ancestors + [owner]
+      # a page can't be moved under itself or its descendants
+      old_owners = {}
+      moved = []
+      for page in pages:
+        if page.key() in ancestors:
+          continue
+        old_owner = Page.owner.get_value_for_datastore(page)
+        if old_owner == owner:
+          continue
+        old_owners[page.key()] = old_owner
+        page.owner = owner
+        moved.append(page)
+      if moved:
+        save_pages(moved, old_owners)
+      pages = moved
+    else:
+      pages = []
+
+    query = self.request.get('filters')
+    self.redirect("/admin?%sbulk=%s&count=%d" % (query and query + '&' or '', urllib.quote(action), len(pages)))
+
 # AdminPublishHandler
 # Publishes draft page
 
@@ -361,10 +3265,7 @@ class AdminPublishHandler(webapp.RequestHandler):
     if not page:
       return error_404()
     page.draft = False
-    page.put()
-    memcache.set("page-%s" % page.url, page)
-    memcache.delete("site-links")
-    memcache.delete("feed")
+    save_pages([page])
     self.redirect("/admin?published=%s" % key)
 
 # AdminUnPublishHandler
@@ -380,10 +3281,7 @@ class AdminUnPublishHandler(webapp.RequestHandler):
     if not page:
       return error_404()
     page.draft = True
-    page.put()
-    memcache.set("page-%s" % page.url, page)
-    memcache.delete("site-links")
-    memcache.delete("feed")
+    save_pages([page])
     self.redirect("/admin?unpublished=%s" % key)
 
 # AdminRemoveHandler
@@ -396,13 +3294,7 @@ class AdminRemoveHandler(webapp.RequestHandler):
     page = get_page(url);
     if not page:
       return error_404()
-    if page.owner:
-      memcache.delete('subpage-%s' % str(page.owner.key()))
-      
-    page.delete()
-    memcache.delete("page-%s" % url)
-    memcache.delete("site-links")
-    memcache.delete("feed")
+    remove_pages([page])
     self.redirect("/admin?removed=true")
 
 # AdminEditHandler
@@ -418,25 +3310,6 @@ class AdminEditHandler(webapp.RequestHandler):
     if url:
       page = get_page(url)
 
-    files = memcache.get('files')
-    if files is None:
-      files = []
-      query = Media.all()
-      query.order('-uploaded')
-      f = query.fetch(1000)
-      for file in f:
-        files.append({
-          'width': file.height,
-          'height': file.width,
-          'type':file.type,
-          'key':str(file.key()),
-          'name':file.name,
-          'status':'OK',
-          'description':file.description
-        })
-      if files:
-        memcache.set('files', files)
-
     #Render page
     template_values = {
         'site_title': site_prefs['title'],
@@ -448,7 +3321,7 @@ class AdminEditHandler(webapp.RequestHandler):
         'front':page and site_prefs['front']==page.url or False,
         'links': get_links(),
         'logouturl': users.create_logout_url("/"),
-        'files': json.dumps(files)
+        'srcset_widths': json.dumps(IMAGE_SRCSET_WIDTHS)
     }
     path = os.path.join(os.path.dirname(__file__), 'views/edit.html')
     self.response.out.write(template.render(path, template_values))
@@ -474,36 +3347,40 @@ class AdminEditHandler(webapp.RequestHandler):
       except:
         page = False
 
-    memcache.delete('site-links')
-    
-    if not page:
+    created = not page
+    if created:
       page = Page()
       page.url = get_unique_url(len(url) and url or u'page') # url is set at the first save
-    
+      old_owner = None
+    else:
+      old_owner = Page.owner.get_value_for_datastore(page)
+    # descendants show the title and the owner chain in their breadcrumbs
+    renamed = not created and page.title != title
 
     page.title = title
     page.content = content
+    preprocess_page(page)
     page.draft = draft
-    
-    if page.owner and page.owner!=owner:
-      memcache.delete('subpage-%s' % str(page.owner.key()))
-    
     page.owner = owner and db.Key(owner) or None
-    
-    if page.owner:
-      memcache.delete('subpage-%s' % str(page.owner.key()))
+    moved = not created and Page.owner.get_value_for_datastore(page) != old_owner
         
     page.put()
-    memcache.set("page-%s" % page.url, page)
-    memcache.delete('feed')
+    if created:
+      index_page_url(page)
+    update_page_node(page)
+    menu_changed = update_menu(page)
+    cache_set("page-%s" % page.url, page)
+    update_feed(page)
+    index_page(page)
+    bump_generation()
     
-    if on_front:
-      # Set to front page
-      site_prefs = get_site_prefs()
-      if not site_prefs['front'] or site_prefs['front']!= page.url:
-        site_prefs['front'] = page.url
-        set_site_prefs(site_prefs)
-        memcache.delete("site-links")
+    site_prefs = get_site_prefs()
+    if on_front and (not site_prefs['front'] or site_prefs['front']!= page.url):
+      # Set to front page, this refreshes all snapshots
+      site_prefs['front'] = page.url
+      set_site_prefs(site_prefs)
+    else:
+      refresh_snapshots(snapshot_urls(page, old_owner, renamed or moved), everything=menu_changed)
     
     self.redirect("/admin?saved=%s" % str(page.key()))
 
@@ -521,6 +3398,9 @@ class AdminSiteHandler(webapp.RequestHandler):
         'description': site_prefs['description'],
         'templateText': site_prefs['templateText'],
         'templateDefault': site_prefs['templateDefault'],
+        'feedItems': feed_limit(site_prefs),
+        'feedExcerpts': site_prefs['feedExcerpts'],
+        'snapshots': site_prefs['snapshots'],
         'links': get_links(),
         'logouturl': users.create_logout_url("/")
     }
@@ -531,6 +3411,12 @@ class AdminSiteHandler(webapp.RequestHandler):
     description = self.request.get('description')
     templateText = self.request.get('templateText')
     use_own_template = self.request.get('use_own_template') and True or False
+    feed_excerpts = self.request.get('feedExcerpts') and True or False
+    snapshots = self.request.get('snapshots') and True or False
+    try:
+      feed_items = max(1, int(self.request.get('feedItems')))
+    except:
+      feed_items = 10
     
     templateDefault = not use_own_template
     
@@ -543,78 +3429,219 @@ class AdminSiteHandler(webapp.RequestHandler):
     site_prefs['description'] = description
     site_prefs['templateText'] = len(templateText) and templateText or False
     site_prefs['templateDefault'] = templateDefault
+    site_prefs['feedItems'] = feed_items
+    site_prefs['feedExcerpts'] = feed_excerpts
+    site_prefs['snapshots'] = snapshots
     
     set_site_prefs(site_prefs)
     
     self.redirect("/admin?updated=true")
 
-# AdminUploadHandler
-# Upload file
+# AdminRebuildSearchHandler
+# Rebuilds the search index for all pages, a batch per request to stay
+# within the request deadline
 
-class AdminUploadHandler(webapp.RequestHandler):
+class AdminRebuildSearchHandler(webapp.RequestHandler):
+  def get(self):
+    query = Page.all()
+    cursor = self.request.get('cursor')
+    if cursor:
+      query.with_cursor(cursor)
+    pages = query.fetch(100)
+
+    index_pages(pages)
+
+    if len(pages) == 100:
+      self.redirect("/admin/rebuild-search?cursor=%s" % urllib.quote(query.cursor()))
+    else:
+      bump_generation()
+      self.redirect("/admin?reindexed=true")
+
+# AdminExportHandler
+# Downloads the whole site as an archive, see export_records()
+
+class AdminExportHandler(webapp.RequestHandler):
+  def get(self):
+    self.response.headers['Content-Type'] = 'application/x-ndjson; charset=utf-8'
+    self.response.headers['Content-Disposition'] = 'attachment; filename="site-%s.ndjson"' % date.today().isoformat()
+    write_archive(self.response.out)
+
+# AdminImportHandler
+# Imports an uploaded archive for up to IMPORT_TIME_BUDGET seconds. A large
+# archive is imported by uploading it again until the import is done
+
+class AdminImportHandler(webapp.RequestHandler):
   def post(self):
+    upload = self.request.params.get('archive')
+    if not hasattr(upload, 'file'):
+      self.redirect("/admin")
+      return
+    state = import_archive(upload.file, time.time() + IMPORT_TIME_BUDGET)
+    self.redirect("/admin?imported=%d%s" % (state['records'], not state['done'] and '&paused=true' or ''))
+
+# AdminStatsHandler
+# Shows the request statistics of the last hour per route and the slow
+# request log, and sets the threshold of the slow request log
+
+class AdminStatsHandler(webapp.RequestHandler):
+  def get(self):
+    site_prefs = get_site_prefs()
 
     template_values = {
-        'status':'',
-        'width': 0,
-        'height': 0,
-        'type':'',
-        'key':'',
-        'name':'',
-        'description':''
+        'site_title': site_prefs['title'],
+        'description': site_prefs['description'],
+        'routes': get_stats(),
+        'categories': STATS_CATEGORIES,
+        'histogram': ['<%d' % bound for bound in STATS_HISTOGRAM] + ['>%d' % STATS_HISTOGRAM[-1]],
+        'window': STATS_WINDOW * STATS_BUCKET // 60,
+        'slow': memcache.get('stats-slow') or [],
+        'slowRequestMs': site_prefs['slowRequestMs'],
+        'links': get_links(),
+        'logouturl': users.create_logout_url("/")
     }
-    
-    if not self.request.get('file') or len(self.request.get('file'))>1024*1024:
-      template_values['status'] = 'ERROR'
-      path = os.path.join(os.path.dirname(__file__), 'views/upload_response.html')
-      self.response.out.write(template.render(path, template_values))
-      return
-
-    media = Media()
-    # strip out the path Internet Explorer provides with the filename
-    media.name = self.request.params['file'].filename.encode('utf-8').split("\\").pop().decode('utf-8')
-    media.description = self.request.get('description')
+    path = os.path.join(os.path.dirname(__file__), 'views/stats.html')
+    self.response.out.write(template.render(path, template_values))
 
+  def post(self):
     try:
-      img = images.Image(self.request.get('file'))
-      width = img.width
-      height = img.height
-      
-      media.type="IMAGE"
-      
-      if width>800 or height>600:
-        img.resize(width=800, height=600)
-        
-      img.im_feeling_lucky()
-      media.file = img.execute_transforms(output_encoding=images.JPEG)
-
-      img = images.Image(media.file)
-      media.width = img.width
-      media.height = img.height
-      
-      img.resize(width=80, height=60)
-      img.im_feeling_lucky()
-      media.thumbnail = img.execute_transforms(output_encoding=images.JPEG)
+      threshold = max(0, int(self.request.get('slowRequestMs')))
     except:
-      media.file = self.request.get('file')
-      media.type="FILE"
-      media.width = 0
-      media.height = 0
+      threshold = 0
 
-    media.put()
-    
-    template_values['status'] = 'OK'
-    template_values['type'] = media.type
-    template_values['name'] = media.name
-    template_values['width'] = media.width
-    template_values['height'] = media.height
-    template_values['description'] = media.description
-    template_values['key'] = str(media.key())
-    
-    memcache.delete('files')
+    site_prefs = get_site_prefs()
+    if site_prefs['slowRequestMs'] != threshold:
+      site_prefs['slowRequestMs'] = threshold
+      set_site_prefs(site_prefs)
+    if not threshold:
+      memcache.delete('stats-slow')
+
+    self.redirect("/admin/stats")
+
+# AdminUploadHandler
+# Uploads one or more files. The files are stored as they are and the
+# response is sent right away, uploads that may be images are processed
+# by a background task (see process_upload()). The editor follows their
+# status with AdminUploadStatusHandler. Files that were uploaded before
+# (same digest) only get a new Media row for the stored content
+
+class AdminUploadHandler(webapp.RequestHandler):
+  def post(self):
+    description = self.request.get('description')
+    results = []
+
+    for upload in self.request.params.getall('file'):
+      if not hasattr(upload, 'file'):
+        continue
+      upload.file.seek(0, 2)
+      size = upload.file.tell()
+      upload.file.seek(0)
+
+      # strip out the path Internet Explorer provides with the filename
+      name = upload.filename.encode('utf-8').split("\\").pop().decode('utf-8')
+      if not size or size>MAX_UPLOAD_SIZE:
+        results.append({'status': 'ERROR', 'name': name})
+        continue
+
+      media = Media()
+      media.name = name
+      media.description = description
+      media.digest = file_digest(upload.file)
+      source = find_content(media.digest)
+      if source:
+        # the same bytes were uploaded before, their payload is reused
+        share_content(media, source)
+        media.put()
+        if media.status == 'PROCESSING':
+          # only the first upload of the content is processed, it updates
+          # the waiting rows when done. Check whether it finished before
+          # this row was saved
+          current = Media.get(source.key())
+          if not current:
+            enqueue_task('process-upload', key=str(media.key()))
+          elif current.status == 'OK':
+            share_content(media, current)
+            media.put()
+      else:
+        media.type = "FILE"
+        media.width = 0
+        media.height = 0
+        # only files the images API can take are candidates for images
+        media.status = size<=MAX_IMAGE_SIZE and 'PROCESSING' or 'OK'
+        media.put()
+        store_media_chunks(media, upload.file)
+        if media.status == 'PROCESSING':
+          enqueue_task('process-upload', key=str(media.key()))
+      results.append(media_summary(media))
+
+    if not results:
+      results.append({'status': 'ERROR', 'name': u''})
+
+    cache_delete('media-list')
+    template_values = {
+        # </script> must not end the script block the results are written to
+        'results': json.dumps(results).replace('</', '<\\/')
+    }
     path = os.path.join(os.path.dirname(__file__), 'views/upload_response.html')
     self.response.out.write(template.render(path, template_values))
 
+# AdminFilesHandler
+# Returns one page of the media library (newest first) as json, with the
+# cursor of the next page. The first page is cached
+
+FILES_PER_PAGE = 50
+
+class AdminFilesHandler(webapp.RequestHandler):
+  def get(self):
+    cursor = self.request.get('cursor')
+    files = not cursor and cache_get('media-list') or None
+    if files is None:
+      queue_media_blobs()
+      query = Media.all()
+      query.order('-uploaded')
+      if cursor:
+        try:
+          query.with_cursor(cursor)
+        except:
+          return error_404(self)
+      batch = query.fetch(FILES_PER_PAGE)
+      files = {
+          'files': [media_summary(media) for media in batch],
+          'cursor': len(batch) == FILES_PER_PAGE and query.cursor() or None
+      }
+      if not cursor:
+        cache_set('media-list', files)
+
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.headers['Cache-Control'] = 'no-cache'
+    self.response.out.write(json.dumps(files))
+
+# AdminUploadStatusHandler
+# Returns the current state of the given uploads (key parameters) as json
+
+class AdminUploadStatusHandler(webapp.RequestHandler):
+  def get(self):
+    keys = []
+    for key in self.request.get_all('key'):
+      try:
+        key = db.Key(key)
+      except:
+        continue
+      if key.kind() == 'Media':
+        keys.append(key)
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.headers['Cache-Control'] = 'no-cache'
+    self.response.out.write(json.dumps([media_summary(media) for media in Media.get(keys) if media]))
+
+# AdminTaskHandler
+# Runs a background task posted by the task queue
+
+class AdminTaskHandler(webapp.RequestHandler):
+  def post(self, name):
+    task = TASKS.get(name)
+    if not task:
+      return error_404(self)
+    task(**dict([(str(arg), self.request.get(arg)) for arg in self.request.arguments()]))
+
 # RemoveMedia
 # Deletes selected file
 
@@ -626,76 +3653,266 @@ class RemoveMedia(webapp.RequestHandler):
     except:
       image = False
     if image:
-      image.delete()
+      delete_media(image)
     
-    memcache.delete('image_%s_%s' % ('full',key))
-    memcache.delete('image_%s_%s' % ('thumb',key))
-    memcache.delete('media_%s' % key)
-    memcache.delete('files')
+    for size in ('full','thumb') + IMAGE_DERIVATIVE_SIZES:
+      cache_delete('image_%s_%s' % (size,key))
+    cache_delete('media_%s' % key)
+    cache_delete('media-list')
     
     self.response.out.write('deleted')
 
 # ImageHandler
-# Displays selected image in requested size (full size on thumbnail)
+# Displays selected image in requested size (full size, thumbnail or one
+# of IMAGE_DERIVATIVE_SIZES). Only the bytes of the requested size are cached and the response can be
+# cached by browsers and proxies, images never change after the upload.
+# Images addressed by digest are cached for a year and marked immutable
+
+IMAGE_MAX_AGE = 30*24*60*60
+MISSING_IMAGE_TTL = 60
 
 class ImageHandler(webapp.RequestHandler):
   def get(self, size, key, name=''):
     
+    if size not in ('full', 'thumb') and size not in IMAGE_DERIVATIVE_SIZES:
+      return error_404(self)
+
     image = memcache.get('image_%s_%s' % (size,key))
     if image is None:
-      try:
-        image = Media.get(key) 
-      except:
+      media = get_media(key)
+      data = None
+      if media and media.type == 'IMAGE':
+        if size in IMAGE_DERIVATIVE_SIZES:
+          data = get_derivative(media, size)
+        else:
+          data = media_variant(media, size)
+      if data:
+        image = {
+            'data': data,
+            'etag': '"%s-%s"' % (size, hashlib.md5(data).hexdigest()),
+            'modified': media.uploaded
+        }
+      else:
         image = False
-      memcache.set('image_%s_%s' % (size,key), image)
+      # a missing image may still be processing, misses are kept briefly
+      memcache.set('image_%s_%s' % (size,key), image, image is False and MISSING_IMAGE_TTL or 0)
 
     if image:
       self.response.headers['Content-Type'] = 'image/jpeg'
-      self.response.out.write(size=='full' and image.file or image.thumbnail)
+      if CONTENT_DIGEST.match(key):
+        self.response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % IMMUTABLE_MAX_AGE
+      else:
+        self.response.headers['Cache-Control'] = 'public, max-age=%d' % IMAGE_MAX_AGE
+      if not_modified(self, image['etag'], image['modified']):
+        return
+      self.response.out.write(image['data'])
     else:
       return error_404(self)
 
 # MediaHandler
 # Forces download of selected file
+# The file is read from the datastore a chunk at a time and single byte
+# ranges are supported, so interrupted downloads can be resumed. webapp
+# buffers the whole response body before sending it, so a download still
+# takes the size of the file in memory, which MAX_UPLOAD_SIZE bounds
 
 class MediaHandler(webapp.RequestHandler):
   def get(self, key, name=''):
     
-    media = memcache.get('media_%s' % key)
-    if media is None:
-      try:
-        media = Media.get(key) 
-      except:
-        media = False
-      memcache.set('media_%s' % key, media)
+    media = get_media_info(key)
+    if not media:
+      return error_404(self)
 
-    if media:
-      self.response.headers['Content-Type'] = 'application/octet-stream'
-      self.response.headers['Content-disposition'] = 'attachment; filename="%s"' % str(media.name)
-      self.response.out.write(media.file)
+    try:
+      self.send(key, name, media)
+    except MissingMediaData:
+      # the cached info outlived the payload
+      cache_delete('media_%s' % key)
+      self.response.clear()
+      for header in ('Content-disposition', 'Accept-Ranges', 'Cache-Control', 'Content-Range',
+                     'Content-Encoding', 'ETag', 'Last-Modified', 'Vary'):
+        del self.response.headers[header]
+      self.response.headers['Content-Type'] = 'text/html; charset=utf-8'
+      error_404(self)
+
+  def send(self, key, name, media):
+    # uploads of the same content share the digest url, the name in the url
+    # is the one of the upload it was linked from
+    if CONTENT_DIGEST.match(key) and name:
+      name = name.replace('"', '')
     else:
-      return error_404(self)
+      name = media['name']
+    self.response.headers['Content-Type'] = 'application/octet-stream'
+    self.response.headers['Content-disposition'] = 'attachment; filename="%s"' % str(name)
+    self.response.headers['Accept-Ranges'] = 'bytes'
+    if CONTENT_DIGEST.match(key):
+      self.response.headers['Cache-Control'] = 'public, max-age=%d, immutable' % IMMUTABLE_MAX_AGE
+    etag = '"%s"' % (media.get('digest') or text_digest(media['key']))
+    size = media['size']
+
+    # whole downloads of compressible files are sent compressed, ranges
+    # always refer to the uncompressed file
+    data = None
+    extension = name.rsplit('.', 1)[-1].lower()
+    if (size and size <= MAX_COMPRESS_FILE_SIZE and extension not in PRECOMPRESSED_EXTENSIONS
+        and not self.request.headers.get('Range')):
+      etag, data = compressed_variant(self, etag, lambda: ''.join(read_media(media, 0, size - 1)))
+    if not_modified(self, etag, media['uploaded']):
+      return
+    if data:
+      self.response.out.write(data)
+      return
+
+    start, end = 0, size - 1
+    byte_range = size and parse_range(self.request.headers.get('Range'), size)
+    if byte_range is False:
+      self.response.set_status(416)
+      self.response.headers['Content-Range'] = 'bytes */%d' % size
+      return
+    if byte_range:
+      start, end = byte_range
+      self.response.set_status(206)
+      self.response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+
+    if size:
+      for data in read_media(media, start, end):
+        self.response.out.write(data)
+
+# CachedWSGIApplication
+# WSGI application that gives every request its own request cache and
+# flushes the cache writes of the request in one batch at the end. The call
+# statistics of the request are added to the totals of its route
+
+class CachedWSGIApplication(webapp.WSGIApplication):
+  def __call__(self, environ, start_response):
+    begin_stats()
+    begin_request(environ_host(environ))
+    try:
+      return webapp.WSGIApplication.__call__(self, environ, start_response)
+    finally:
+      end_request()
+      path = environ.get('PATH_INFO', '')
+      end_stats(self.route_name(path), path)
+
+  def route_name(self, path):
+    for regexp, handler in self._url_mapping:
+      if regexp.match(path):
+        return handler.__name__
+    return 'NotFound'
+
+install_instrumentation()
+
+# The application is built once per instance and reused by every request
+application = CachedWSGIApplication([('/', PageHandler),
+                                     (r'/page/(.*)', PageHandler),
+                                     (r'/image/(.*)/(.*)/(.*)', ImageHandler),
+                                     (r'/download/(.*)/(.*)', MediaHandler),
+                                     ('/feed', FeedHandler),
+                                     ('/search', SearchHandler),
+                                     ('/admin/upload', AdminUploadHandler),
+                                     ('/admin', AdminMainHandler),
+                                     ('/admin/add', AdminEditHandler),
+                                     ('/admin/site', AdminSiteHandler),
+                                     ('/admin/edit', AdminEditHandler),
+                                     ('/admin/remove-media', RemoveMedia),
+                                     ('/admin/publish', AdminPublishHandler),
+                                     ('/admin/unpublish', AdminUnPublishHandler),
+                                     ('/admin/rebuild-search', AdminRebuildSearchHandler),
+                                     ('/admin/stats', AdminStatsHandler),
+                                     ('/admin/upload-status', AdminUploadStatusHandler),
+                                     ('/admin/files', AdminFilesHandler),
+                                     ('/admin/bulk', AdminBulkHandler),
+                                     ('/admin/export', AdminExportHandler),
+                                     ('/admin/import', AdminImportHandler),
+                                     (r'/admin/tasks/(.*)', AdminTaskHandler),
+                                     (r'/admin/edit/(.*)', AdminEditHandler),
+                                     (r'/admin/remove/(.*)', AdminRemoveHandler)
+                                     ],
+                                    debug=False)
 
 def main():
-  application = webapp.WSGIApplication([('/', PageHandler),
-                                        (r'/page/(.*)', PageHandler),
-                                        (r'/image/(.*)/(.*)/(.*)', ImageHandler),
-                                        (r'/download/(.*)/(.*)', MediaHandler),
-                                        ('/feed', FeedHandler),
-                                        ('/admin/upload', AdminUploadHandler),
-                                        ('/admin', AdminMainHandler),
-                                        ('/admin/add', AdminEditHandler),
-                                        ('/admin/site', AdminSiteHandler),
-                                        ('/admin/edit', AdminEditHandler),
-                                        ('/admin/remove-media', RemoveMedia),
-                                        ('/admin/publish', AdminPublishHandler),
-                                        ('/admin/unpublish', AdminUnPublishHandler),
-                                        (r'/admin/edit/(.*)', AdminEditHandler),
-                                        (r'/admin/remove/(.*)', AdminRemoveHandler)
-                                        ],
-                                       debug=True)
+  if not template_cache_warm:
+    warm_template_cache()
+  import wsgiref.handlers
   wsgiref.handlers.CGIHandler().run(application)
 
+# register_local_stubs()
+# function registers the SDK stubs of the users and images APIs when running
+# outside of App Engine, so the admin pages can create logout urls and
+# uploads can be resized. The API proxy itself is kept because the
+# statistics hooks are installed on it
+
+def register_local_stubs():
+  try:
+    from google.appengine.api import apiproxy_stub_map
+  except ImportError:
+    return
+  apiproxy = apiproxy_stub_map.apiproxy
+  os.environ.setdefault('AUTH_DOMAIN', 'gmail.com')
+  if not apiproxy.GetStub('user'):
+    from google.appengine.api import user_service_stub
+    apiproxy.RegisterStub('user', user_service_stub.UserServiceStub())
+  if not apiproxy.GetStub('images'):
+    try:
+      from google.appengine.api.images import images_stub
+      apiproxy.RegisterStub('images', images_stub.ImagesServiceStub())
+    except ImportError:
+      logging.warning('PIL is not installed, uploaded images are stored as files')
+
+# serve()
+# @param host String
+# @param port Integer
+# function serves the application from a long-lived multi-threaded WSGI
+# server, for running outside of App Engine (python main.py serve [port])
+
+def serve(host='0.0.0.0', port=8080):
+  from wsgiref.simple_server import make_server, WSGIServer
+  try:
+    from SocketServer import ThreadingMixIn
+  except ImportError:
+    from socketserver import ThreadingMixIn
+
+  class ThreadedWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+  # the users stub builds the login and logout urls from these
+  os.environ.setdefault('SERVER_NAME', host == '0.0.0.0' and 'localhost' or host)
+  os.environ.setdefault('SERVER_PORT', str(port))
+  register_local_stubs()
+  warm_template_cache()
+  server = make_server(host, port, application, server_class=ThreadedWSGIServer)
+  logging.info('Serving on http://%s:%d/' % (host, port))
+  server.serve_forever()
+
+# run_command()
+# @param command String
+# @param path String
+# function exports the site to a file (stdout without a path) or imports an
+# archive file from the command line, without any request deadline:
+# python main.py export [path], python main.py import path
+
+def run_command(command, path=None):
+  register_local_stubs()
+  begin_request()
+  try:
+    if command == 'export':
+      out = path and open(path, 'w') or sys.stdout
+      write_archive(out)
+      if path:
+        out.close()
+    else:
+      stream = open(path, 'rb')
+      state = import_archive(stream)
+      stream.close()
+      logging.info('Imported %d records from %s' % (state['records'], path))
+  finally:
+    end_request()
+
 
 if __name__ == '__main__':
-  main()
\ No newline at end of file
+  if sys.argv[1:2] == ['serve']:
+    serve(port=len(sys.argv) > 2 and int(sys.argv[2]) or 8080)
+  elif sys.argv[1:2] in (['export'], ['import']):
+    run_command(sys.argv[1], len(sys.argv) > 2 and sys.argv[2] or None)
+  else:
+    main()